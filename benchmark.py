@@ -0,0 +1,493 @@
+"""
+Offline end-to-end benchmark for on_message.
+
+Every backend is replaced by a local fake: an OpenAI-compatible streaming server, Ollama
+(/api/generate), the SD WebUI (/sdapi/v1/txt2img), the kernel-memory plugin (/swagger.json,
+/searchmemory, /upsert), the TTS server (/synthesize_and_send) and Discord's webhook API.
+Discord messages and channels are plain Python stand-ins, so no tokens or network are needed.
+
+Ollama, the WebUI and the TTS server are called on fixed localhost ports (11434, 7860, 5000),
+so those must be free while the benchmark runs.
+
+    python benchmark.py --conversations 8 --turns 5 --token-rate 40
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import socket
+import tempfile
+import time
+from collections import defaultdict
+
+import discord
+from aiohttp import web
+
+OLLAMA_PORT = 11434
+SDWEBUI_PORT = 7860
+TTS_PORT = 5000
+# 1x1 PNG, stands in for attachments and generated images
+TINY_PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8/5+hHgAHggJ/PchI7wAAAABJRU5ErkJggg==")
+REPLY_WORDS = (
+    "The torchlight flickers across the damp stone walls of the keep as the old guard steps aside. "
+    "Beyond the gate the market of Elfmeria hums with merchants, bards and pickpockets alike. "
+    "What will you do ?"
+).split()
+
+timings = defaultdict(list)
+server_counts = defaultdict(int)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def record(stage, seconds):
+    timings[stage].append(seconds)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+############### Fake backends #####################
+
+
+def llm_app(args):
+    async def chat_completions(request):
+        server_counts["llm"] += 1
+        body = await request.json()
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(args.ttft)
+
+        words = ["<think>", "planning", "the", "scene", "</think>\n\n"]
+        words += [REPLY_WORDS[i % len(REPLY_WORDS)] + (" " if (i + 1) % 40 else "\n\n") for i in range(args.reply_tokens)]
+        for i, word in enumerate(words + [None]):
+            chunk = {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "benchmark"),
+                "choices": [{"index": 0, "delta": {"content": word} if word else {}, "finish_reason": None if word else "stop"}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if word:
+                await asyncio.sleep(1 / args.token_rate)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+def ollama_app(args):
+    async def generate(request):
+        body = await request.json()
+        if body.get("images"):
+            server_counts["vision"] += 1
+            await asyncio.sleep(args.vision_delay)
+            return web.json_response({"response": "A hooded traveller holding a lantern.", "done_reason": "stop"})
+        server_counts["intent"] += 1
+        await asyncio.sleep(args.intent_delay)
+        return web.json_response({"response": "action_intent", "done_reason": "stop"})
+
+    app = web.Application()
+    app.router.add_post("/api/generate", generate)
+    return app
+
+
+def sdwebui_app(args):
+    async def txt2img(request):
+        body = await request.json()
+        images = body.get("batch_size", 1) * body.get("n_iter", 1)
+        server_counts["sd_calls"] += 1
+        server_counts["sd_images"] += images
+        await asyncio.sleep(args.sd_delay * images)
+        return web.json_response({"images": [base64.b64encode(TINY_PNG).decode()] * images})
+
+    async def interrupt(request):
+        server_counts["sd_interrupts"] += 1
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post("/sdapi/v1/txt2img", txt2img)
+    app.router.add_post("/sdapi/v1/interrupt", interrupt)
+    return app
+
+
+def tts_app(args):
+    async def synthesize_and_send(request):
+        server_counts["tts"] += 1
+        await asyncio.sleep(args.tts_delay)
+        return web.json_response({"message": "Audio sent."})
+
+    async def synthesize(request):
+        server_counts["tts"] += 1
+        await asyncio.sleep(args.tts_delay)
+        return web.Response(body=b"RIFF0000WAVE", content_type="audio/wav")
+
+    app = web.Application()
+    app.router.add_post("/synthesize_and_send", synthesize_and_send)
+    app.router.add_post("/synthesize", synthesize)
+    return app
+
+
+def memory_app(args):
+    request_body = {"content": {"application/json": {"schema": {"type": "object", "properties": {"body": {"type": "object"}}}}}}
+    swagger = {
+        "openapi": "3.0.1",
+        "info": {"title": "kernel-memory-plugin", "version": "1.0"},
+        "paths": {
+            "/searchmemory": {"post": {"operationId": "searchmemory", "description": "Search memories", "requestBody": request_body}},
+            "/upsert": {"post": {"operationId": "upsert", "description": "Remember something", "requestBody": request_body}},
+        },
+    }
+
+    async def swagger_json(request):
+        return web.json_response(swagger)
+
+    async def searchmemory(request):
+        server_counts["searchmemory"] += 1
+        body = await request.json()
+        await asyncio.sleep(args.memory_delay)
+        return web.json_response({"query": body.get("query"), "results": [{"partitions": [{"text": "The old guard owes Borus a favour.", "relevance": 0.9}]}]})
+
+    async def upsert(request):
+        server_counts["upsert"] += 1
+        body = await request.json()
+        await asyncio.sleep(args.memory_delay)
+        return web.json_response({"index": body.get("index"), "documentId": body.get("documentId")})
+
+    app = web.Application()
+    app.router.add_get("/swagger.json", swagger_json)
+    app.router.add_post("/searchmemory", searchmemory)
+    app.router.add_post("/upsert", upsert)
+    return app
+
+
+def discord_api_app(args):
+    async def execute_webhook(request):
+        server_counts["webhook_posts"] += 1
+        await request.read()
+        return web.Response(status=204)
+
+    async def attachment(request):
+        return web.Response(body=TINY_PNG, content_type="image/png")
+
+    app = web.Application()
+    app.router.add_post("/api/v10/webhooks/{webhook_id}/{token}", execute_webhook)
+    app.router.add_get("/attachments/{name}", attachment)
+    return app
+
+
+async def start_app(app, port):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+############### Fake Discord objects #####################
+
+message_ids = itertools.count(1_000_000_000_000_000_000)
+
+
+class FakeUser:
+    def __init__(self, user_id, bot=False):
+        self.id = user_id
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+        self.roles = []
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return self.id
+
+
+class FakeAttachment:
+    def __init__(self, url):
+        self.url = url
+        self.filename = url.rsplit("/", 1)[-1]
+        self.content_type = "image/png"
+
+
+class FakeReference:
+    def __init__(self, message):
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.resolved = None
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeChannel:
+    def __init__(self, channel_id, conversation):
+        self.id = channel_id
+        self.type = discord.ChannelType.private
+        self.conversation = conversation
+        self.messages = {}
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, content=None, **kwargs):
+        return self.conversation.new_message(self.conversation.bot_user, content or "", **kwargs)
+
+    async def fetch_message(self, message_id):
+        if message_id not in self.messages:
+            raise discord.NotFound(FakeHTTPResponse(404), "Unknown Message")
+        return self.messages[message_id]
+
+    async def history(self, limit=100, before=None):
+        for message in sorted(self.messages.values(), key=lambda message: -message.id)[:limit]:
+            if before is None or message.id < before.id:
+                yield message
+
+
+class FakeHTTPResponse:
+    def __init__(self, status):
+        self.status = status
+        self.reason = ""
+
+
+class FakeMessage:
+    def __init__(self, conversation, author, content, reference=None, attachments=(), embed=None):
+        self.id = next(message_ids)
+        self.conversation = conversation
+        self.channel = conversation.channel
+        self.author = author
+        self.content = content
+        self.reference = reference
+        self.attachments = list(attachments)
+        self.embeds = [embed] if embed else []
+        self.mentions = []
+        self.channel.messages[self.id] = self
+
+    async def reply(self, content=None, embed=None, **kwargs):
+        self.conversation.mark("first_reply")
+        return self.conversation.new_message(self.conversation.bot_user, content or "", reference=FakeReference(self), embed=embed)
+
+    async def edit(self, embed=None, **kwargs):
+        self.conversation.mark("first_edit")
+        self.conversation.edits += 1
+        if embed:
+            self.embeds = [embed]
+
+
+class Conversation:
+    def __init__(self, channel_id, user, bot_user):
+        self.user = user
+        self.bot_user = bot_user
+        self.channel = FakeChannel(channel_id, self)
+        self.turn_started = None
+        self.marks = {}
+        self.edits = 0
+        self.last_bot_message = None
+
+    def new_message(self, author, content, **kwargs):
+        message = FakeMessage(self, author, content, **kwargs)
+        if author == self.bot_user and kwargs.get("embed") is not None:
+            self.last_bot_message = message
+        return message
+
+    def mark(self, name):
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter() - self.turn_started
+            record(name, self.marks[name])
+
+
+############### Harness #####################
+
+
+def configure_environment(args, ports, workdir):
+    # llmcord and its modules read these at import time; load_dotenv() won't override them
+    os.environ.update({
+        "DISCORD_BOT_TOKEN": "benchmark",
+        "OPENAI_API_KEY": "benchmark",
+        "MISTRAL_API_KEY": "benchmark",
+        "NVIDIA_API_KEY": "benchmark",
+        "ELEVENLABS_API_KEY": "benchmark",
+        "LLM": "local",
+        "LLM_FALLBACK_PROVIDERS": "",
+        "LOCAL_SERVER_URL": f"http://127.0.0.1:{ports['llm']}/v1",
+        "API_SERVER_URL": f"http://127.0.0.1:{ports['memory']}",
+        # discord.Webhook.from_url wants a 17-20 digit id and a token of 60+ characters
+        "DISCORD_BOT_WEBHOOK": "https://discord.com/api/webhooks/123456789012345678/" + "benchmark-webhook-token-" * 3,
+        "ALLOWED_CHANNEL_IDS": "",
+        "ALLOWED_ROLE_IDS": "",
+        "MAX_IMAGES": "5",
+        "MAX_MESSAGES": "20",
+        "CUSTOM_SYSTEM_PROMPT": "You are the dungeon master of Terralum.",
+        "TOOL_SCHEMA_CACHE_PATH": os.path.join(workdir, "tool_schema_cache.json"),
+        "DESCRIPTION_CACHE_PATH": "",
+        "MSG_STORE_PATH": "",
+        "MEMORY_SPILL_PATH": os.path.join(workdir, "memory_spill.jsonl"),
+    })
+
+
+def instrument(llmcord, function_calling):
+    def timed(stage, func):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter() - started)
+        return wrapper
+
+    llmcord.build_msg_nodes = timed("chain", llmcord.build_msg_nodes)
+    llmcord.describe_images = timed("description", llmcord.describe_images)
+    llmcord.get_intent = timed("intent", llmcord.get_intent)
+    function_calling.retrieve_memories = timed("memory", function_calling.retrieve_memories)
+
+    stream = llmcord.llm_router.stream
+
+    async def timed_stream(**kwargs):
+        started = time.perf_counter()
+        tokens = 0
+        async for chunk in stream(**kwargs):
+            if not tokens:
+                record("llm_first_chunk", time.perf_counter() - started)
+            tokens += 1
+            yield chunk
+        record("llm_stream", time.perf_counter() - started)
+        server_counts["tokens_streamed"] += tokens
+
+    llmcord.llm_router.stream = timed_stream
+
+
+async def run_conversation(llmcord, conversation, args, index):
+    for turn in range(args.turns):
+        content = f"{conversation.bot_user.mention} I walk to the market and ask the old guard about the keep, turn {turn}"
+        if args.intent:
+            content += " <@BOT ID>"
+        attachments = [FakeAttachment(f"{args.attachment_base}/scene_{index}_{turn}.png")] if args.images else []
+        reference = FakeReference(conversation.last_bot_message) if conversation.last_bot_message else None
+        message = conversation.new_message(conversation.user, content, reference=reference, attachments=attachments)
+
+        conversation.turn_started = time.perf_counter()
+        conversation.marks = {}
+        await llmcord.on_message(message)
+        record("turn_total", time.perf_counter() - conversation.turn_started)
+
+
+async def drain(llmcord, timeout):
+    # Wait for image, TTS and memory work queued by the replies
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        busy = (
+            llmcord.sd_scheduler.pending
+            or llmcord.sd_scheduler.running
+            or any(stats["depth"] for stats in llmcord.job_queue.stats().values())
+            or llmcord.narrator.streams
+        )
+        if not busy:
+            break
+        await asyncio.sleep(0.05)
+    await llmcord.memory_writer.flush()
+    return time.perf_counter() - started
+
+
+def report(args, wall_time, drain_time):
+    print(f"\n{args.conversations} conversations x {args.turns} turns, LLM {args.token_rate} tokens/s, TTFT {args.ttft}s")
+    print(f"{'stage':<18}{'n':>6}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for stage, values in sorted(timings.items()):
+        print(f"{stage:<18}{len(values):>6}" + "".join(f"{percentile(values, fraction) * 1000:>8.0f}ms" for fraction in (0.5, 0.9, 0.99)) + f"{max(values) * 1000:>8.0f}ms")
+    turns = len(timings["turn_total"])
+    print(f"\nwall time {wall_time:.2f}s, background drain {drain_time:.2f}s")
+    print(f"throughput {turns / wall_time:.2f} turns/s, {server_counts['tokens_streamed'] / wall_time:.0f} tokens/s")
+    print("backend requests: " + ", ".join(f"{name}={count}" for name, count in sorted(server_counts.items())))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as report_file:
+            json.dump({
+                "args": vars(args),
+                "wall_time": wall_time,
+                "drain_time": drain_time,
+                "stages": {stage: {"n": len(values), "p50": percentile(values, 0.5), "p90": percentile(values, 0.9), "p99": percentile(values, 0.99), "max": max(values)} for stage, values in timings.items()},
+                "backend_requests": dict(server_counts),
+            }, report_file, indent=2)
+
+
+async def main(args):
+    ports = {"llm": free_port(), "memory": free_port(), "discord": free_port()}
+    workdir = tempfile.mkdtemp(prefix="llmcord-benchmark-")
+    configure_environment(args, ports, workdir)
+    args.attachment_base = f"http://127.0.0.1:{ports['discord']}/attachments"
+
+    runners = [
+        await start_app(llm_app(args), ports["llm"]),
+        await start_app(memory_app(args), ports["memory"]),
+        await start_app(discord_api_app(args), ports["discord"]),
+        await start_app(ollama_app(args), OLLAMA_PORT),
+        await start_app(sdwebui_app(args), SDWEBUI_PORT),
+        await start_app(tts_app(args), TTS_PORT),
+    ]
+
+    import discord.webhook.async_
+    import function_calling
+    import llmcord
+
+    # Webhook URLs must look like Discord's, send them to the fake API instead
+    discord.webhook.async_.Route.BASE = f"http://127.0.0.1:{ports['discord']}/api/v10"
+    bot_user = FakeUser(1, bot=True)
+    llmcord.discord_client._connection.user = bot_user
+    instrument(llmcord, function_calling)
+
+    llmcord.worker_pool.start()
+    llmcord.session_manager.start()
+    llmcord.job_queue.start()
+    llmcord.sd_scheduler.start()
+    llmcord.memory_writer.start()
+    await llmcord.tool_schema.refresh()
+    try:
+        conversations = [Conversation(10_000 + i, FakeUser(100 + i), bot_user) for i in range(args.conversations)]
+        started = time.perf_counter()
+        await asyncio.gather(*(run_conversation(llmcord, conversation, args, i) for i, conversation in enumerate(conversations)))
+        wall_time = time.perf_counter() - started
+        drain_time = await drain(llmcord, args.drain_timeout)
+    finally:
+        await llmcord.sd_scheduler.stop()
+        await llmcord.job_queue.stop()
+        await llmcord.narrator.stop()
+        await llmcord.memory_writer.close()
+        await llmcord.session_manager.close()
+        await llmcord.worker_pool.close()
+        for runner in runners:
+            await runner.cleanup()
+    report(args, wall_time, drain_time)
+    if server_counts["sd_images"] and not server_counts["webhook_posts"]:
+        raise SystemExit("Images were generated but no webhook post reached the fake Discord API, delivery was not measured")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark for on_message with fake backends")
+    parser.add_argument("--conversations", type=int, default=4, help="concurrent conversations, one channel each")
+    parser.add_argument("--turns", type=int, default=3, help="messages per conversation, each replying to the last bot reply")
+    parser.add_argument("--token-rate", type=float, default=50, help="LLM tokens per second per stream")
+    parser.add_argument("--reply-tokens", type=int, default=120, help="LLM tokens per reply, after the think block")
+    parser.add_argument("--ttft", type=float, default=0.3, help="LLM time to first token, seconds")
+    parser.add_argument("--intent-delay", type=float, default=0.2, help="Ollama intent classification latency")
+    parser.add_argument("--vision-delay", type=float, default=1.0, help="llava description latency")
+    parser.add_argument("--memory-delay", type=float, default=0.1, help="kernel-memory search/upsert latency")
+    parser.add_argument("--sd-delay", type=float, default=2.0, help="SD WebUI latency per image")
+    parser.add_argument("--tts-delay", type=float, default=0.5, help="TTS latency per request")
+    parser.add_argument("--images", action="store_true", help="attach an image to every message")
+    parser.add_argument("--intent", action="store_true", help="mention <@BOT ID> so intent classification runs")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="seconds to wait for background image/TTS work")
+    parser.add_argument("--json", help="also write the report to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import os
+import time
+
+# How long a reply may wait on the message it replies to before going ahead without it
+REPLY_WAIT_TIMEOUT = float(os.environ.get("REPLY_WAIT_TIMEOUT", 300))
+
+
+class CompletionRegistry:
+    """
+    Tracks bot replies that are still streaming, keyed by message id.
+
+    Messages replying to one of them await its event instead of polling. Entries older than
+    max_age are released on the next start() in case a handler died before calling finish().
+    """
+
+    def __init__(self, max_age=REPLY_WAIT_TIMEOUT):
+        self.max_age = max_age
+        self.events = {}
+
+    def __len__(self):
+        return len(self.events)
+
+    def __contains__(self, msg_id):
+        return msg_id in self.events
+
+    def start(self, msg_id):
+        self.prune()
+        self.events[msg_id] = (asyncio.Event(), time.monotonic())
+
+    def finish(self, msg_id):
+        entry = self.events.pop(msg_id, None)
+        if entry:
+            entry[0].set()
+
+    def prune(self):
+        now = time.monotonic()
+        for msg_id in [msg_id for msg_id, (_, started) in self.events.items() if now - started > self.max_age]:
+            logging.warning(f"Releasing reply {msg_id}, still marked in progress after {self.max_age}s")
+            self.finish(msg_id)
+
+    async def wait(self, msg_id, timeout=REPLY_WAIT_TIMEOUT):
+        """
+        Waits until the reply with this id has finished streaming.
+
+        :param msg_id: int, Discord message id
+        :param timeout: float, seconds to wait at most
+        :return: bool, False if the wait timed out
+        """
+        entry = self.events.get(msg_id)
+        if entry is None:
+            return True
+        try:
+            await asyncio.wait_for(entry[0].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logging.warning(f"Gave up waiting on reply {msg_id} after {timeout}s")
+            return False
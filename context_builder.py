@@ -0,0 +1,125 @@
+import logging
+import os
+
+# Our models aren't OpenAI's, but cl100k is close enough for budgeting; without tiktoken (or its
+# BPE file), ~4 chars per token
+try:
+    import tiktoken
+    encoding = tiktoken.get_encoding("cl100k_base")
+except (ImportError, OSError):
+    encoding = None
+
+# Prompt tokens allowed per completion, leave room for MAX_COMPLETION_TOKENS in the model's window
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 6144))
+MEMORY_PLACEHOLDER = "(%mem%)"
+# Role, name and separators the chat template wraps around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+# Attachments are sent with detail "low", a flat 85 tokens on OpenAI vision models
+IMAGE_PART_TOKENS = 85
+
+
+def count_tokens(text):
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def truncate_tokens(text, max_tokens):
+    if max_tokens <= 0:
+        return ""
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    if len(text) <= max_tokens * 4:
+        return text
+    text = text[:max_tokens * 4]
+    # Don't cut a memory off mid-word
+    cut = max(text.rfind("\n"), text.rfind(" "))
+    return text[:cut] if cut > 0 else text
+
+
+def message_tokens(content):
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD_TOKENS + count_tokens(content)
+    # Vision content: a list of text and image_url parts
+    return MESSAGE_OVERHEAD_TOKENS + sum(count_tokens(part["text"]) if part.get("type") == "text" else IMAGE_PART_TOKENS for part in content)
+
+
+def node_tokens(node):
+    # Nodes are immutable once built, so their count is computed once and kept on the node
+    if node.token_count is None:
+        node.token_count = message_tokens(node.content)
+    return node.token_count
+
+
+class ContextBuilder:
+    """
+    Assembles the chat completion messages within a token budget.
+
+    Components are kept in priority order: the system prompt and the current message always go
+    in, the memory dump is truncated to what is left, and history fills the rest newest first,
+    so the oldest messages are the first to go.
+    """
+
+    def __init__(self, budget=CONTEXT_TOKEN_BUDGET):
+        self.budget = budget
+        self.counters = {"builds": 0, "trimmed_builds": 0, "memory_trimmed": 0, "history_trimmed": 0, "history_messages_trimmed": 0, "over_budget": 0}
+
+    def build(self, system_prompt, memory, chain_nodes):
+        """
+        :param system_prompt: list of system messages, MEMORY_PLACEHOLDER marks where the memories go
+        :param memory: str, memory dump for the placeholder
+        :param chain_nodes: list of MsgNode, the current message first, then what it replies to
+        :return: (list of messages in chronological order, dict report of token use and trimming)
+        """
+        system_tokens = sum(message_tokens(message["content"].replace(MEMORY_PLACEHOLDER, "")) for message in system_prompt)
+        current_tokens = node_tokens(chain_nodes[0])
+        remaining = self.budget - system_tokens - current_tokens
+
+        full_memory_tokens = memory_tokens = count_tokens(memory)
+        if memory_tokens > remaining:
+            memory = truncate_tokens(memory, remaining)
+            memory_tokens = count_tokens(memory)
+        remaining -= memory_tokens
+
+        history = []
+        history_tokens = 0
+        for node in chain_nodes[1:]:
+            tokens = node_tokens(node)
+            if tokens > remaining:
+                break
+            history.append(node)
+            history_tokens += tokens
+            remaining -= tokens
+        trimmed_nodes = chain_nodes[1 + len(history):]
+
+        report = {
+            "budget": self.budget,
+            "used": system_tokens + current_tokens + memory_tokens + history_tokens,
+            "system": system_tokens,
+            "current": current_tokens,
+            "memory": memory_tokens,
+            "history": history_tokens,
+            "memory_trimmed": full_memory_tokens - memory_tokens,
+            "history_trimmed": sum(node_tokens(node) for node in trimmed_nodes),
+            "history_messages_trimmed": len(trimmed_nodes),
+        }
+        self._record(report)
+
+        messages = [dict(message, content=message["content"].replace(MEMORY_PLACEHOLDER, memory)) for message in system_prompt]
+        messages += [node.msg for node in reversed(chain_nodes[:1 + len(history)])]
+        return messages, report
+
+    def _record(self, report):
+        self.counters["builds"] += 1
+        if report["used"] > self.budget:
+            self.counters["over_budget"] += 1
+            logging.warning(f"System prompt and current message alone exceed the context budget: {report}")
+        if report["memory_trimmed"] or report["history_trimmed"]:
+            self.counters["trimmed_builds"] += 1
+            for key in ("memory_trimmed", "history_trimmed", "history_messages_trimmed"):
+                self.counters[key] += report[key]
+            logging.info(f"Trimmed context to fit {self.budget} tokens: {report}")
+
+    def stats(self):
+        return dict(self.counters)
@@ -0,0 +1,92 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DESCRIPTION_CACHE_MAX_ENTRIES = int(os.environ.get("DESCRIPTION_CACHE_MAX_ENTRIES", 256))
+# On-disk tier, empty to keep descriptions in memory only
+DESCRIPTION_CACHE_PATH = os.environ.get("DESCRIPTION_CACHE_PATH", "image_descriptions.sqlite3")
+DESCRIPTION_CACHE_MAX_DISK_ENTRIES = int(os.environ.get("DESCRIPTION_CACHE_MAX_DISK_ENTRIES", 10000))
+
+
+def description_key(image_bytes, model, prompt):
+    digest = hashlib.sha256(image_bytes)
+    digest.update(b"\0" + model.encode("utf-8") + b"\0" + prompt.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class DescriptionCache:
+    """
+    Vision model descriptions keyed by a hash of the image bytes, model and prompt.
+
+    A small in-memory LRU sits in front of an optional SQLite table; both are size bounded and
+    evict the least recently used descriptions first.
+    """
+
+    def __init__(self, max_entries=DESCRIPTION_CACHE_MAX_ENTRIES, path=DESCRIPTION_CACHE_PATH, max_disk_entries=DESCRIPTION_CACHE_MAX_DISK_ENTRIES):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self.lock = threading.Lock()
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS descriptions (key TEXT PRIMARY KEY, description TEXT, last_used REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS descriptions_last_used ON descriptions (last_used)")
+            self.conn.commit()
+
+    async def get(self, key):
+        description = self.entries.get(key)
+        if description is not None:
+            self.entries.move_to_end(key)
+            self.counters["memory_hits"] += 1
+            return description
+        if self.conn:
+            description = await asyncio.to_thread(self._read, key)
+            if description is not None:
+                self.counters["disk_hits"] += 1
+                self._remember(key, description)
+                return description
+        self.counters["misses"] += 1
+        return None
+
+    async def put(self, key, description):
+        self._remember(key, description)
+        if self.conn:
+            await asyncio.to_thread(self._write, key, description)
+
+    def _remember(self, key, description):
+        self.entries[key] = description
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _read(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT description FROM descriptions WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.conn.execute("UPDATE descriptions SET last_used = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+            return row[0] if row else None
+
+    def _write(self, key, description):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO descriptions VALUES (?, ?, ?)", (key, description, time.time()))
+            self.conn.execute(
+                "DELETE FROM descriptions WHERE key IN ("
+                " SELECT key FROM descriptions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_entries,),
+            )
+            self.conn.commit()
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+
+    def stats(self):
+        return {"entries": len(self.entries), **self.counters}
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import os
+import time
+
+import discord
+
+from metrics import metrics
+
+# Discord allows roughly 5 message edits per 5 seconds per channel, and 50 requests per second per bot
+EDIT_CHANNEL_RATE = float(os.environ.get("EDIT_CHANNEL_RATE", 1.0))
+EDIT_CHANNEL_BURST = float(os.environ.get("EDIT_CHANNEL_BURST", 2))
+EDIT_GLOBAL_RATE = float(os.environ.get("EDIT_GLOBAL_RATE", 10))
+EDIT_GLOBAL_BURST = float(os.environ.get("EDIT_GLOBAL_BURST", 10))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        # Seconds until a token is available
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def penalize(self, seconds):
+        # After a 429, hold this bucket empty for retry_after seconds
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class EmbedBuffer:
+    """Streamed reply text kept as chunks, joined only when an edit is actually sent."""
+
+    __slots__ = ("parts", "length")
+
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+
+    def append(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+
+    def text(self):
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+
+class EditScheduler:
+    """
+    Sends streaming embed edits through per-channel and global token buckets.
+
+    Only the newest pending state of each message is kept. Edits requested while an earlier one
+    is waiting for a token replace it, so a busy channel sends fewer, fuller edits instead of
+    queueing stale ones into 429s.
+    """
+
+    def __init__(self, channel_rate=EDIT_CHANNEL_RATE, channel_burst=EDIT_CHANNEL_BURST, global_rate=EDIT_GLOBAL_RATE, global_burst=EDIT_GLOBAL_BURST):
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.channel_buckets = {}
+        self.pending = {}
+        self.flushers = {}
+        self.counters = {"requested": 0, "sent": 0, "coalesced": 0, "rate_limited": 0, "failed": 0}
+
+    def submit(self, message, render):
+        """
+        Schedules an edit of a bot message.
+
+        :param message: discord.Message to edit
+        :param render: callable returning the discord.Embed to send, called right before sending
+        """
+        self.counters["requested"] += 1
+        if message.id in self.pending:
+            self.counters["coalesced"] += 1
+        self.pending[message.id] = (message, render)
+        flusher = self.flushers.get(message.id)
+        if flusher is None or flusher.done():
+            self.flushers[message.id] = asyncio.create_task(self._flush(message.id))
+
+    async def flush(self, message_id):
+        # Wait until every edit submitted for this message has been sent
+        flusher = self.flushers.get(message_id)
+        if flusher:
+            await asyncio.wait({flusher})
+
+    async def _acquire(self, channel_id):
+        channel_bucket = self.channel_buckets.get(channel_id)
+        if channel_bucket is None:
+            channel_bucket = self.channel_buckets[channel_id] = TokenBucket(self.channel_rate, self.channel_burst)
+        while True:
+            delay = max(channel_bucket.delay(), self.global_bucket.delay())
+            if delay <= 0:
+                channel_bucket.take()
+                self.global_bucket.take()
+                return channel_bucket
+            await asyncio.sleep(delay)
+
+    async def _flush(self, message_id):
+        try:
+            while message_id in self.pending:
+                message, _ = self.pending[message_id]
+                channel_bucket = await self._acquire(message.channel.id)
+                # Newer edits may have replaced the one we waited for, send the latest
+                message, render = self.pending.pop(message_id)
+                try:
+                    with metrics.span("discord_edit"):
+                        await message.edit(embed=render())
+                    self.counters["sent"] += 1
+                except discord.HTTPException as e:
+                    if e.status != 429:
+                        self.counters["failed"] += 1
+                        logging.warning(f"Failed to edit message {message_id}: {e}")
+                        continue
+                    self.counters["rate_limited"] += 1
+                    retry_after = getattr(e, "retry_after", None) or 1.0
+                    channel_bucket.penalize(retry_after)
+                    self.pending.setdefault(message_id, (message, render))
+        finally:
+            self.flushers.pop(message_id, None)
+
+    def stats(self):
+        return {"in_flight": len(self.flushers), **self.counters}
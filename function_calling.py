@@ -3,16 +3,22 @@
 from datetime import datetime
 import os
 import json
+import re
 import jsonref
-from openai import OpenAI
+from openai import APIError, AsyncOpenAI
 import requests
 from pprint import pp
 import aiohttp
 import traceback
 import asyncio
+import time
 from dotenv import load_dotenv
 from aiohttp import ClientTimeout
 
+from http_sessions import get_session, session_manager
+from memory_cache import memory_search_cache
+from metrics import metrics
+
 
 load_dotenv()
 
@@ -35,7 +41,27 @@ MAX_CALLS = 1
 
 API_URL = os.environ["API_SERVER_URL"] #'http://localhost:7071'
 
-client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+# Tool planning runs for many channels at once; cap how many completions are in flight
+# and how long each may take so one slow completion can't hold up the rest
+MAX_CONCURRENT_TOOL_CALLS = int(os.environ.get("MAX_CONCURRENT_TOOL_CALLS", 4))
+TOOL_CALL_TIMEOUT = float(os.environ.get("TOOL_CALL_TIMEOUT", 60))
+
+# "fast" builds the memory search query locally and skips the planning completion,
+# "planner" asks the model to plan every lookup
+MEMORY_RETRIEVAL_MODE = os.environ.get("MEMORY_RETRIEVAL_MODE", "fast")
+# Same values SYSTEM_MESSAGE tells the planner to use
+MEMORY_SEARCH_INDEX = "default"
+MEMORY_MIN_RELEVANCE = 0.8
+MEMORY_SEARCH_LIMIT = 5
+MAX_QUERY_KEYWORDS = 8
+STOPWORDS = frozenset("""
+about above after again against all also and any are because been before being below between both but can could did does doing down during each few for from further had has have having her here hers herself him himself his how into its itself just let more most must not now off once only other our ours ourselves out over own same she should some such than that the their theirs them themselves then there these they this those through too under until very was were what when where which while who whom why will with would you your yours yourself yourselves
+tell said says say asked ask know think thought like want wants need needs get got make made see saw look looks looked come came going goes went take took give gave back still even well really yes okay
+""".split())
+
+# TOOL_CALL_TIMEOUT is enforced around the whole call, retries included, in get_openai_response
+client = AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"])
+tool_call_semaphore = asyncio.Semaphore(MAX_CONCURRENT_TOOL_CALLS)
 
 #client.base_url = "http://localhost:11434/v1"
 #client.api_key= 'ollama'
@@ -47,16 +73,16 @@ async def send_post_request(api_url, data):
     headers = {'Content-Type': 'application/json'}
 
     # Using aiohttp for async HTTP requests
-    async with aiohttp.ClientSession() as session:
-        async with session.post(api_url, json=data, headers=headers, timeout=timeout) as response:
-            # Check if the request was successful
-            if response.status == 200:
-                # Assuming the response is JSON-formatted
-                response_data = await response.json()
-                return response_data
-            else:
-                # Handle unsuccessful requests
-                return f"Request failed. Status code: {response.status}"
+    session = get_session("memory")
+    async with session.post(api_url, json=data, headers=headers, timeout=timeout) as response:
+        # Check if the request was successful
+        if response.status == 200:
+            # Assuming the response is JSON-formatted
+            response_data = await response.json()
+            return response_data
+        else:
+            # Handle unsuccessful requests
+            return f"Request failed. Status code: {response.status}"
 
 
 def openapi_to_functions(openapi_spec):
@@ -104,18 +130,138 @@ def openapi_to_functions(openapi_spec):
     return functions
 
 
-def get_openai_response(functions, messages):
-    return client.chat.completions.create(
-        model="<your model>",
-        tools=functions,
-        # "auto" means the model can pick between generating a message or calling a function.
-        tool_choice="auto",
-        temperature=0,
-        messages=messages,
-    )
+@metrics.timed("tool_call_llm")
+async def get_openai_response(functions, messages):
+    async with tool_call_semaphore:
+        return await asyncio.wait_for(
+            client.chat.completions.create(
+                model="<your model>",
+                tools=functions,
+                # "auto" means the model can pick between generating a message or calling a function.
+                tool_choice="auto",
+                temperature=0,
+                messages=messages,
+            ),
+            timeout=TOOL_CALL_TIMEOUT,
+        )
+
+
+async def execute_tool_call(tool_call):
+    arguments_json = tool_call.function.arguments
+    arguments_dict = json.loads(arguments_json)
+
+    print(f"arguments_dict == {0}", arguments_dict)
+
+    if "parameters" in arguments_dict and "body" in arguments_dict["parameters"]:
+        body = arguments_dict["parameters"]["body"]
+    elif "body" in arguments_dict:
+        body = arguments_dict["body"]
+    else:
+        print("Key 'parameters' or 'body' not found in the arguments dictionary")
+        raise KeyError("'parameters' or 'body' key not found in the arguments dictionary")
+
+    return await call_memory_api(tool_call.function.name, body)
 
 
-async def process_user_instruction(functions, instruction, prev_message):
+async def call_memory_api(function_name, body):
+    new_api_url = API_URL + "/" + function_name
+    operation = function_name.lower()
+
+    if operation == "searchmemory":
+        cached = memory_search_cache.get(body)
+        if cached is not None:
+            print(f"memory cache hit >> {body.get('query')}")
+            return cached
+        generation = memory_search_cache.generation(body.get("index"))
+    elif operation == "upsert":
+        memory_search_cache.invalidate(body.get("index"))
+
+    print(f"sending to url >> {0}", new_api_url)
+
+    started = time.monotonic()
+    try:
+        with metrics.span("memory_api", operation=operation):
+            apiresponse = await send_post_request(new_api_url, body)
+    finally:
+        if operation == "upsert":
+            # Again once the write has landed (or failed), searches that started while it was in
+            # flight may have read the old data under the new generation
+            memory_search_cache.invalidate(body.get("index"))
+    print(json.dumps(apiresponse, indent=4))
+    # Failed requests come back as a status string, only cache real results
+    if operation == "searchmemory" and not isinstance(apiresponse, str):
+        memory_search_cache.put(body, apiresponse, time.monotonic() - started, generation)
+    return apiresponse
+
+
+def extract_memory_query(message, prev_message=""):
+    """
+    Builds a searchmemory query from the names and keywords in a message, no LLM involved.
+
+    Capitalised words that don't start a sentence are treated as names of characters, places and
+    events and rank first. Words from the message outrank words from the previous assistant turn.
+
+    :param message: str, the user's message
+    :param prev_message: str, the assistant message being replied to
+    :return: str, space separated keywords, empty if nothing useful was found
+    """
+    scores = {}
+    first_seen = {}
+    for weight, text in ((2, message), (1, prev_message)):
+        text = re.sub(r"<[@#][!&]?\d+>|<think>.*?</think>", " ", text or "", flags=re.DOTALL)
+        for sentence in re.split(r"[.!?\n]+", text):
+            for position, word in enumerate(re.findall(r"[A-Za-z][\w'-]*", sentence)):
+                key = word.lower()
+                if key in STOPWORDS or len(key) < 3:
+                    continue
+                is_name = word[0].isupper() and position > 0
+                score = weight * (3 if is_name else 1 if len(key) >= 4 else 0)
+                if not score:
+                    continue
+                scores[key] = scores.get(key, 0) + score
+                first_seen.setdefault(key, word)
+    keywords = sorted(scores, key=lambda key: -scores[key])[:MAX_QUERY_KEYWORDS]
+    return " ".join(first_seen[key] for key in keywords)
+
+
+@metrics.timed("memory_retrieval")
+async def retrieve_memories(functions, message, prev_message="", use_planner=False):
+    """
+    Looks up memories relevant to a message before replying.
+
+    The fast path extracts the query locally and calls /searchmemory directly with the values the
+    planner prompt hard-codes anyway. The LLM planner is used when MEMORY_RETRIEVAL_MODE is
+    "planner" or the caller asks for it.
+
+    :return: str of search results, or None when nothing was found
+    """
+    if use_planner or MEMORY_RETRIEVAL_MODE == "planner":
+        return await process_user_instruction(functions, message, prev_message)
+
+    query = extract_memory_query(message, prev_message)
+    if not query:
+        return None
+    print(f"fast memory query >> {query}")
+    try:
+        apiresponse = await call_memory_api("searchmemory", {
+            "query": query,
+            "index": MEMORY_SEARCH_INDEX,
+            "minRelevance": MEMORY_MIN_RELEVANCE,
+            "limit": MEMORY_SEARCH_LIMIT,
+        })
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Memory search failed: {e}")
+        return None
+    if isinstance(apiresponse, str):
+        return None
+    return str(apiresponse)
+
+
+@metrics.timed("memory_planner")
+async def process_user_instruction(functions, instruction, prev_message=""):
+    if not functions:
+        print("Tool schema not loaded yet, skipping tool planning")
+        return None
     num_calls = 0
     formatted_datetime = datetime.now().strftime('%B %d %Y, %H:%M:%S')
     new_instruction = instruction + " worldtime is: " + formatted_datetime
@@ -126,7 +272,15 @@ async def process_user_instruction(functions, instruction, prev_message):
         {"content": new_instruction, "role": "user"},
     ]
     # while num_calls < MAX_CALLS:
-    response = get_openai_response(functions, messages)
+    try:
+        response = await get_openai_response(functions, messages)
+    except asyncio.TimeoutError:
+        print(f"Tool planning timed out after {TOOL_CALL_TIMEOUT}s")
+        return None
+    except APIError as e:
+        # Connection errors and error statuses left after the client's own retries
+        print(f"Tool planning failed: {e}")
+        return None
     message = response.choices[0].message
     #print(message)
     try:
@@ -135,38 +289,18 @@ async def process_user_instruction(functions, instruction, prev_message):
         # messages.append(message)
 
         if message.tool_calls and len(message.tool_calls) > 0:
-            results = []
-            for tool_call in message.tool_calls:
-                if tool_call.function:
-                    arguments_json = tool_call.function.arguments
-                    arguments_dict = json.loads(arguments_json)
-
-                    print(f"arguments_dict == {0}", arguments_dict)
-
-                    if "parameters" in arguments_dict and "body" in arguments_dict["parameters"]:
-                        body = arguments_dict["parameters"]["body"]
-                    elif "body" in arguments_dict:
-                        body = arguments_dict["body"]
-                    else:
-                        print("Key 'parameters' or 'body' not found in the arguments dictionary")
-                        raise KeyError("'parameters' or 'body' key not found in the arguments dictionary")
-
-                    new_api_url = API_URL + "/" + tool_call.function.name
-
-                    print(f"sending to url >> {0}", new_api_url)
-                    
-                    apiresponse = await send_post_request(new_api_url, body)
-                    print(json.dumps(apiresponse, indent=4))
-                    
-                    results.append(apiresponse)
-
-                    messages.append(
-                        {
-                            "role": "tool",
-                            "content": apiresponse,
-                            "tool_call_id": tool_call.id,
-                        }
-                    )
+            tool_calls = [tool_call for tool_call in message.tool_calls if tool_call.function]
+            # The model may plan several calls at once (e.g. two searches), run them concurrently
+            results = await asyncio.gather(*(execute_tool_call(tool_call) for tool_call in tool_calls))
+
+            for tool_call, apiresponse in zip(tool_calls, results):
+                messages.append(
+                    {
+                        "role": "tool",
+                        "content": apiresponse,
+                        "tool_call_id": tool_call.id,
+                    }
+                )
 
             results_string = "\n".join(str(result) for result in results)
             return results_string
@@ -214,6 +348,7 @@ async def main():
     result = await process_user_instruction(functions, USER_INSTRUCTION, "")
     print("\n>>>>>>>>>>>>>>>>>RESULT>>>>>>>>>>>>>\n")
     print(result)
+    await session_manager.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,93 @@
+import logging
+import os
+
+import aiohttp
+
+# Per-backend connection pools. Each local service gets its own connector so a burst of
+# SD or TTS requests can't starve the memory plugin or Ollama of sockets.
+BACKEND_LIMITS = {
+    "ollama": int(os.environ.get("OLLAMA_MAX_CONNECTIONS", 4)),         # :11434
+    "sdwebui": int(os.environ.get("SDWEBUI_MAX_CONNECTIONS", 2)),       # :7860
+    "tts": int(os.environ.get("TTS_MAX_CONNECTIONS", 2)),               # :5000
+    "memory": int(os.environ.get("MEMORY_MAX_CONNECTIONS", 8)),         # :7071
+    "discord": int(os.environ.get("DISCORD_HTTP_MAX_CONNECTIONS", 10)),  # webhooks and attachment downloads
+    "default": int(os.environ.get("DEFAULT_MAX_CONNECTIONS", 10)),
+}
+KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 75))
+DNS_CACHE_TTL = 300
+
+
+class SessionManager:
+    def __init__(self, limits=BACKEND_LIMITS):
+        self.limits = limits
+        self.sessions = {}
+        self.counters = {}
+
+    def _trace_config(self, backend):
+        counters = self.counters.setdefault(backend, {"requests": 0, "connections_created": 0, "connections_reused": 0})
+
+        async def on_request_start(session, ctx, params):
+            counters["requests"] += 1
+
+        async def on_connection_create_end(session, ctx, params):
+            counters["connections_created"] += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            counters["connections_reused"] += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def get(self, backend="default"):
+        """
+        Returns the shared session for a backend, creating it on first use.
+
+        :param backend: str, one of the keys of BACKEND_LIMITS
+        :return: aiohttp.ClientSession
+        """
+        if backend not in self.limits:
+            backend = "default"
+        session = self.sessions.get(backend)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limits[backend],
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=DNS_CACHE_TTL,
+            )
+            session = aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config(backend)])
+            self.sessions[backend] = session
+        return session
+
+    def start(self):
+        # Must be called from inside the running loop
+        for backend in self.limits:
+            self.get(backend)
+
+    def stats(self):
+        stats = {}
+        for backend, session in self.sessions.items():
+            connector = session.connector
+            stats[backend] = {
+                "limit": self.limits[backend],
+                "in_use": len(getattr(connector, "_acquired", ())) if connector else 0,
+                "idle": sum(len(conns) for conns in getattr(connector, "_conns", {}).values()) if connector else 0,
+                **self.counters.get(backend, {}),
+            }
+        return stats
+
+    async def close(self):
+        logging.info(f"HTTP pool stats at shutdown: {self.stats()}")
+        for session in self.sessions.values():
+            if not session.closed:
+                await session.close()
+        self.sessions.clear()
+
+
+session_manager = SessionManager()
+
+
+def get_session(backend="default"):
+    return session_manager.get(backend)
@@ -0,0 +1,124 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import deque
+
+# Jobs run after the reply has streamed. Each type gets its own queue and worker count;
+# TTS defaults to one at a time because it shares our single local GPU. Images go through
+# sd_scheduler, which batches them in front of the WebUI.
+JOB_CONCURRENCY = {
+    "tts": int(os.environ.get("TTS_JOB_CONCURRENCY", 1)),
+}
+# Past COALESCE_DEPTH queued jobs, TTS jobs replace a queued job with the same key;
+# past MAX_DEPTH they are dropped. Other job types are never dropped.
+JOB_QUEUE_COALESCE_DEPTH = int(os.environ.get("JOB_QUEUE_COALESCE_DEPTH", 2))
+JOB_QUEUE_MAX_DEPTH = int(os.environ.get("JOB_QUEUE_MAX_DEPTH", 8))
+DROPPABLE_JOB_TYPES = ("tts",)
+
+PRIORITY_HIGH = 0    # explicit user commands
+PRIORITY_NORMAL = 1  # automatic side effects of a reply
+
+
+class Job:
+    __slots__ = ("job_type", "factory", "priority", "coalesce_key", "enqueued_at")
+
+    def __init__(self, job_type, factory, priority, coalesce_key):
+        self.job_type = job_type
+        self.factory = factory
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        self.enqueued_at = time.monotonic()
+
+
+class JobQueue:
+    def __init__(self, concurrency=JOB_CONCURRENCY, coalesce_depth=JOB_QUEUE_COALESCE_DEPTH, max_depth=JOB_QUEUE_MAX_DEPTH):
+        self.concurrency = concurrency
+        self.coalesce_depth = coalesce_depth
+        self.max_depth = max_depth
+        self.queues = {}
+        self.queued = {}
+        self.workers = []
+        self.counter = itertools.count()
+        self.counters = {job_type: {"submitted": 0, "completed": 0, "failed": 0, "coalesced": 0, "dropped": 0} for job_type in concurrency}
+        self.wait_times = {job_type: deque(maxlen=200) for job_type in concurrency}
+
+    def start(self):
+        # Must be called from inside the running loop
+        for job_type, workers in self.concurrency.items():
+            self.queues[job_type] = asyncio.PriorityQueue()
+            for _ in range(workers):
+                self.workers.append(asyncio.create_task(self._worker(job_type)))
+
+    async def stop(self):
+        logging.info(f"Job queue stats at shutdown: {self.stats()}")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers.clear()
+
+    def submit(self, job_type, factory, priority=PRIORITY_NORMAL, coalesce_key=None):
+        """
+        Queues a background job.
+
+        :param job_type: str, one of the keys of JOB_CONCURRENCY
+        :param factory: callable returning the coroutine to run, called when a worker picks the job up
+        :param priority: int, lower runs first
+        :param coalesce_key: optional hashable, a newer TTS job with the same key replaces a queued one
+        :return: bool, False if the job was dropped
+        """
+        counters = self.counters[job_type]
+        counters["submitted"] += 1
+        depth = self.queues[job_type].qsize()
+
+        if job_type in DROPPABLE_JOB_TYPES:
+            queued_job = self.queued.get((job_type, coalesce_key)) if coalesce_key is not None else None
+            if queued_job and depth >= self.coalesce_depth:
+                # Only the newest scene matters, reuse the queued slot for it
+                queued_job.factory = factory
+                counters["coalesced"] += 1
+                return True
+            if depth >= self.max_depth:
+                counters["dropped"] += 1
+                logging.warning(f"Dropped {job_type} job, {depth} already queued")
+                return False
+
+        job = Job(job_type, factory, priority, coalesce_key)
+        if coalesce_key is not None:
+            self.queued[(job_type, coalesce_key)] = job
+        self.queues[job_type].put_nowait((priority, next(self.counter), job))
+        return True
+
+    async def _worker(self, job_type):
+        queue = self.queues[job_type]
+        while True:
+            _, _, job = await queue.get()
+            if self.queued.get((job_type, job.coalesce_key)) is job:
+                del self.queued[(job_type, job.coalesce_key)]
+            self.wait_times[job_type].append(time.monotonic() - job.enqueued_at)
+            try:
+                await job.factory()
+                self.counters[job_type]["completed"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.counters[job_type]["failed"] += 1
+                logging.exception(f"Background {job_type} job failed")
+            finally:
+                queue.task_done()
+
+    def stats(self):
+        stats = {}
+        for job_type, counters in self.counters.items():
+            wait_times = sorted(self.wait_times[job_type])
+            stats[job_type] = {
+                "depth": self.queues[job_type].qsize() if job_type in self.queues else 0,
+                "wait_p50": wait_times[len(wait_times) // 2] if wait_times else 0.0,
+                "wait_max": wait_times[-1] if wait_times else 0.0,
+                **counters,
+            }
+        return stats
+
+
+job_queue = JobQueue()
@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from openai import AsyncOpenAI
+
+from metrics import metrics
+
+# Providers from LLM_CONFIG to fall back on, in order, after the one named by LLM
+LLM_FALLBACK_PROVIDERS = tuple(name for name in os.environ.get("LLM_FALLBACK_PROVIDERS", "").split(",") if name)
+LLM_MODEL = os.environ.get("LLM_MODEL", "deepseek-ai/deepseek-r1-distill-llama-8b")
+# Start a second provider when the first chunk is later than this percentile of the first one's TTFT
+LLM_HEDGE = bool(int(os.environ.get("LLM_HEDGE", 0)))
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", 0.9))
+LLM_HEDGE_MIN_DELAY = float(os.environ.get("LLM_HEDGE_MIN_DELAY", 1.0))
+# Used until a provider has enough TTFT samples for a percentile
+LLM_HEDGE_DEFAULT_DELAY = float(os.environ.get("LLM_HEDGE_DEFAULT_DELAY", 4.0))
+# Give up on a provider that hasn't sent its first chunk by then, if there is another one to try
+LLM_FIRST_TOKEN_TIMEOUT = float(os.environ.get("LLM_FIRST_TOKEN_TIMEOUT", 30))
+# A provider failing at least this share of its recent requests sits out LLM_COOLDOWN seconds
+LLM_MAX_ERROR_RATE = float(os.environ.get("LLM_MAX_ERROR_RATE", 0.5))
+LLM_COOLDOWN = float(os.environ.get("LLM_COOLDOWN", 60))
+TTFT_WINDOW = 100
+ERROR_WINDOW = 20
+MIN_SAMPLES = 5
+
+
+class Provider:
+    def __init__(self, name, config, model, max_retries):
+        self.name = name
+        self.model = model
+        self.client = AsyncOpenAI(**config, max_retries=max_retries)
+        self.ttfts = deque(maxlen=TTFT_WINDOW)
+        self.outcomes = deque(maxlen=ERROR_WINDOW)
+        self.cooldown_until = 0.0
+        self.counters = {"requests": 0, "wins": 0, "errors": 0, "cancelled": 0}
+
+    def healthy(self):
+        return self.cooldown_until <= time.monotonic()
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def ttft(self, percentile):
+        if len(self.ttfts) < MIN_SAMPLES:
+            return None
+        ttfts = sorted(self.ttfts)
+        return ttfts[min(int(len(ttfts) * percentile), len(ttfts) - 1)]
+
+    def record_success(self, ttft=None):
+        if ttft is not None:
+            self.ttfts.append(ttft)
+        self.outcomes.append(True)
+
+    def record_error(self, error):
+        self.counters["errors"] += 1
+        self.outcomes.append(False)
+        logging.warning(f"LLM provider {self.name} failed: {error!r}")
+        if len(self.outcomes) >= MIN_SAMPLES and self.error_rate() >= LLM_MAX_ERROR_RATE and self.healthy():
+            self.cooldown_until = time.monotonic() + LLM_COOLDOWN
+            logging.warning(f"LLM provider {self.name} is failing {self.error_rate():.0%} of requests, cooling down for {LLM_COOLDOWN}s")
+
+    def stats(self):
+        return {
+            "ttft_p50": self.ttft(0.5) or 0.0,
+            "ttft_p90": self.ttft(0.9) or 0.0,
+            "error_rate": self.error_rate(),
+            "healthy": self.healthy(),
+            **self.counters,
+        }
+
+
+class LLMRouter:
+    """
+    Streams chat completions from the best available provider in LLM_CONFIG.
+
+    The configured provider goes first while it is healthy, then the other healthy ones by
+    median time to first chunk. A provider that errors or stays silent past
+    LLM_FIRST_TOKEN_TIMEOUT is abandoned for the next one. With LLM_HEDGE, the next provider is
+    also started once the current one's first chunk is later than its usual LLM_HEDGE_PERCENTILE,
+    and whichever answers first is kept while the other request is cancelled.
+    """
+
+    def __init__(self, llm_config, provider_names):
+        max_retries = 0 if len(provider_names) > 1 else 2  # with a fallback, failing over beats retrying
+        self.providers = [
+            Provider(name, llm_config[name], os.environ.get(f"LLM_MODEL_{name.upper()}", LLM_MODEL), max_retries)
+            for name in dict.fromkeys(provider_names)
+        ]
+        self.counters = {"requests": 0, "hedges": 0, "hedge_wins": 0, "failovers": 0, "failed": 0}
+
+    def ranked(self):
+        primary, others = self.providers[0], self.providers[1:]
+        healthy = sorted((provider for provider in others if provider.healthy()), key=lambda provider: provider.ttft(0.5) or LLM_HEDGE_DEFAULT_DELAY)
+        ranked = ([primary] if primary.healthy() else []) + healthy
+        # Everything cooling down still beats not answering
+        return ranked + [provider for provider in self.providers if provider not in ranked]
+
+    def hedge_delay(self, provider):
+        ttft = provider.ttft(LLM_HEDGE_PERCENTILE)
+        return max(LLM_HEDGE_MIN_DELAY, ttft if ttft is not None else LLM_HEDGE_DEFAULT_DELAY)
+
+    async def _open(self, provider, kwargs):
+        started = time.monotonic()
+        stream = await provider.client.chat.completions.create(model=provider.model, stream=True, **kwargs)
+        try:
+            first = await stream.__anext__()
+        except BaseException:
+            await stream.close()
+            raise
+        return stream, first, time.monotonic() - started
+
+    async def _first_chunk(self, kwargs):
+        candidates = self.ranked()
+        pending = {}
+        next_index = 0
+        last_error = None
+
+        def launch():
+            nonlocal next_index
+            provider = candidates[next_index]
+            next_index += 1
+            provider.counters["requests"] += 1
+            pending[asyncio.create_task(self._open(provider, kwargs))] = provider
+
+        try:
+            while True:
+                if not pending:
+                    if next_index == len(candidates):
+                        self.counters["failed"] += 1
+                        raise last_error
+                    if next_index:
+                        self.counters["failovers"] += 1
+                    launch()
+                more = next_index < len(candidates)
+                hedge = LLM_HEDGE and more and len(pending) == 1
+                timeout = self.hedge_delay(next(iter(pending.values()))) if hedge else LLM_FIRST_TOKEN_TIMEOUT if more else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    if hedge:
+                        self.counters["hedges"] += 1
+                        launch()
+                        continue
+                    # Nobody answered in time, move on to the next provider
+                    last_error = asyncio.TimeoutError(f"No first chunk within {LLM_FIRST_TOKEN_TIMEOUT}s")
+                    for task, provider in pending.items():
+                        task.cancel()
+                        provider.record_error(last_error)
+                    await asyncio.gather(*pending, return_exceptions=True)
+                    pending.clear()
+                    continue
+
+                winner = None
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        provider.record_error(last_error)
+                    elif winner is None:
+                        winner = (provider, *task.result())
+                    else:
+                        await task.result()[0].close()
+                if winner:
+                    provider, stream, first, ttft = winner
+                    provider.counters["wins"] += 1
+                    if pending and provider is not candidates[0]:
+                        self.counters["hedge_wins"] += 1
+                    provider.record_success(ttft)
+                    metrics.observe("llm_first_chunk_seconds", ttft, provider=provider.name)
+                    return provider, stream, first
+        finally:
+            # Losers of a hedge, or everything if we were cancelled ourselves
+            for task, provider in pending.items():
+                task.cancel()
+                provider.counters["cancelled"] += 1
+            await self._close_losers(pending)
+
+    @staticmethod
+    async def _close_losers(pending):
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, tuple):
+                await result[0].close()
+
+    @staticmethod
+    def _count(provider, chunk):
+        # Servers send one token per content chunk
+        if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+            metrics.inc("llm_tokens_streamed_total", provider=provider.name)
+        return chunk
+
+    async def stream(self, **kwargs):
+        """
+        Async generator of chat completion chunks, like iterating over create(stream=True).
+
+        :param kwargs: create() arguments other than model and stream
+        """
+        self.counters["requests"] += 1
+        provider, stream, first = await self._first_chunk(kwargs)
+        try:
+            with metrics.span("llm_stream", provider=provider.name):
+                yield self._count(provider, first)
+                async for chunk in stream:
+                    yield self._count(provider, chunk)
+        except Exception as e:
+            # Text has already been shown, so a stream that breaks halfway can't fail over
+            provider.record_error(e)
+            raise
+        finally:
+            await stream.close()
+
+    def stats(self):
+        return {**self.counters, "providers": {provider.name: provider.stats() for provider in self.providers}}
@@ -1,3 +1,6 @@
+import time
+BOOT_STARTED = time.perf_counter()
+
 import asyncio
 from datetime import datetime
 import logging
@@ -5,14 +8,33 @@ import os
 
 import discord
 from dotenv import load_dotenv
-from openai import AsyncOpenAI ,OpenAI
-
-from llmcord_utils import createImage, generateImageDescription, url_to_base64, createTTSMessage, synthesizeAndSendAudio, extract_label_text, extract_synthia_text,replace_words ,get_intent
-import function_calling
-import jsonref
-import requests
 
+# Our modules read their settings at import time
 load_dotenv()
+
+from llmcord_utils import generateImageDescription, download_image, encode_image_for_vision, createTTSMessage, synthesizeAndSendAudio, extract_label_text, extract_synthia_text,replace_words ,get_intent
+import function_calling
+from http_sessions import session_manager
+from completion_registry import CompletionRegistry
+from context_builder import ContextBuilder
+from description_cache import DescriptionCache, description_key
+from edit_scheduler import EditScheduler, EmbedBuffer
+from llm_router import LLMRouter, LLM_FALLBACK_PROVIDERS
+from job_queue import job_queue, PRIORITY_HIGH, PRIORITY_NORMAL
+from loop_monitor import loop_monitor, PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS, PROFILE_DIR
+from sd_scheduler import sd_scheduler
+from narration import narrator, STREAMING_TTS
+from scene_tracker import SceneTracker, SPECULATIVE_SCENE_IMAGE
+from memory_cache import memory_search_cache
+from memory_writer import memory_writer
+from metrics import metrics
+from msg_cache import MsgNode, MsgNodeCache, MsgNodeStore, MSG_STORE_PATH
+from system_prompt import SystemPromptTemplate, REPORT_PROMPT_USAGE
+from tool_schema import ToolSchema
+from worker_pool import worker_pool
+
+# Time since BOOT_STARTED at the end of each startup phase, reported once the client is ready
+startup_timings = {"imports": time.perf_counter() - BOOT_STARTED}
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s.%(msecs)03d %(levelname)s: %(message)s",
@@ -46,6 +68,8 @@ MAX_COMPLETION_TOKENS = 1024
 ALLOWED_CHANNEL_TYPES = (discord.ChannelType.text, discord.ChannelType.public_thread, discord.ChannelType.private_thread, discord.ChannelType.private)
 ALLOWED_CHANNEL_IDS = tuple(int(i) for i in os.environ["ALLOWED_CHANNEL_IDS"].split(",") if i)
 ALLOWED_ROLE_IDS = tuple(int(i) for i in os.environ["ALLOWED_ROLE_IDS"].split(",") if i)
+# Users allowed to run !profile
+ADMIN_USER_IDS = tuple(int(i) for i in os.environ.get("ADMIN_USER_IDS", "").split(",") if i)
 MAX_IMAGES = int(os.environ["MAX_IMAGES"]) if LLM_VISION_SUPPORT else 0
 MAX_MESSAGES = int(os.environ["MAX_MESSAGES"])
 MAX_IMAGE_WARNING = f"⚠️ Max {MAX_IMAGES} image{'' if MAX_IMAGES == 1 else 's'} per message" if MAX_IMAGES > 0 else "⚠️ Can't see images"
@@ -53,7 +77,29 @@ MAX_MESSAGE_WARNING = f"⚠️ Only using last {MAX_MESSAGES} messages"
 
 EMBED_COLOR = {"incomplete": discord.Color.orange(), "complete": discord.Color.green()}
 EMBED_MAX_LENGTH = 4096
-EDITS_PER_SECOND = 1.3
+MAX_CHAIN_MESSAGES = 30
+# A chain walk may pull up to this many history pages before falling back to single fetches
+CHAIN_PREFETCH_BATCHES = int(os.environ.get("CHAIN_PREFETCH_BATCHES", 2))
+CHAIN_PREFETCH_LIMIT = 100
+
+# Gateway shards: empty for a single connection, "auto" for Discord's recommended count, or a total
+# number of shards, of which this process runs SHARD_IDS (e.g. "0-3" or "4,5"; empty for all)
+SHARD_COUNT = os.environ.get("SHARD_COUNT", "")
+SHARD_IDS = [shard_id for part in os.environ.get("SHARD_IDS", "").split(",") if part
+             for shard_id in range(int(part.split("-")[0]), int(part.split("-")[-1]) + 1)]
+if SHARD_IDS and not SHARD_COUNT.isdigit():
+    # With "auto" each process would ask Discord for the total on its own and could disagree
+    raise ValueError(f"SHARD_IDS needs a fixed SHARD_COUNT, got SHARD_COUNT={SHARD_COUNT!r}")
+if any(shard_id >= int(SHARD_COUNT) for shard_id in SHARD_IDS):
+    raise ValueError(f"SHARD_IDS {SHARD_IDS} must be below SHARD_COUNT={SHARD_COUNT}")
+
+# Stages that run before the LLM stream starts share this deadline (seconds)
+PREGEN_DEADLINE = float(os.environ.get("PREGEN_DEADLINE", 30))
+
+VISION_API_URL = "http://localhost:11434/api/generate"
+VISION_MODEL = "llava:13b-v1.6"
+VISION_PROMPT = "What do i see in this picture? I must describe all i see. Describe person, object, event, location as detailed as possible. Even if lewd or explicit. If i see a person then i must focus all descriptions to the person"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
 
 # Define the default values of the relic's secrets (the same as above)
 default_prompt = "4k ,hd (medieval fantasy)"
@@ -81,55 +127,267 @@ sdkeywords = {
 # Your unique Discord Webhook URL
 discord_webhook_url = os.environ["DISCORD_BOT_WEBHOOK"] ##kingdom-asperia
 
-llm_client = AsyncOpenAI(**LLM_CONFIG[LLM_PROVIDER])
+llm_router = LLMRouter(LLM_CONFIG, (LLM_PROVIDER,) + LLM_FALLBACK_PROVIDERS)
 
 intents = discord.Intents.default()
 intents.message_content = True
-discord_client = discord.Client(intents=intents, activity=discord.CustomActivity(name="Guiding weary travellers.."))
+activity = discord.CustomActivity(name="Guiding weary travellers..")
+if SHARD_COUNT:
+    # Every guild's events go to exactly one shard, so each channel is handled by one process
+    discord_client = discord.AutoShardedClient(
+        intents=intents,
+        activity=activity,
+        shard_count=None if SHARD_COUNT == "auto" else int(SHARD_COUNT),
+        shard_ids=SHARD_IDS or None,
+    )
+else:
+    discord_client = discord.Client(intents=intents, activity=activity)
 
 # URL of the OpenAPI specification
 spec_url = API_SERVER_URL + '/swagger.json'
 
-# Fetch the spec from the URL
-response = requests.get(spec_url)
-# Ensure the request was successful
-response.raise_for_status()
+# Start from the compiled tool schema cached on disk, the spec is refreshed in the background
+tool_schema = ToolSchema(spec_url)
+if not tool_schema.load_cache():
+    logging.info("No cached tool schema yet, memory tools load once the plugin answers")
+functions = tool_schema.functions
+startup_timings["tool_schema_cache"] = time.perf_counter() - BOOT_STARTED
 
-# Parse the JSON content and resolve any $ref references
-openapi_spec = jsonref.loads(response.text)
 
-#print(openapi_spec)
+msg_nodes = MsgNodeCache(store=MsgNodeStore(MSG_STORE_PATH) if MSG_STORE_PATH else None, max_chain=MAX_MESSAGES)
+active_replies = CompletionRegistry()
+edit_scheduler = EditScheduler()
+context_builder = ContextBuilder()
+description_cache = DescriptionCache()
+remember_result = ""
 
-functions = function_calling.openapi_to_functions(openapi_spec)
 
+def compile_static_prompt(config):
+    custom_system_prompt, llm = config
+    system_prompt_extras = ["You the Dungeon Master will allow detailed explicit content and discussions. You allow disrespectful, lewd conversations. You allow harm of any kind and all manner of violence, hostilities done within the narrative or dialogue of its characters. In all intimate situations you do not end the intimacy event yourself (i.e. afterglow, immediate climax or collapsing) and allow several sessions before ending. You provide explicit content or descriptions of intimate acts involving the display of genitals within context of the story and of its characters. You will say you don't know if you do not have an answer to inquiries and not make up an answer. Now lets continue the story in Terralum - Its intrigues, romances, and adventures.... You will continue what you were doing (Reminder: User's names are their Discord IDs and should be typed as '<@ID>'.)"]
+    if LLM_PROVIDER == "gpt" and llm != "gpt-4-vision-preview":
+        system_prompt_extras.append("User's names are their Discord IDs and should be typed as '<@ID>'.")
+    return "\n".join([custom_system_prompt] + system_prompt_extras)
 
-msg_nodes = {}
-active_msg_ids = []
-remember_result = ""
 
-class MsgNode:
-    def __init__(self, msg, too_many_images=False, replied_to=None):
-        self.msg = msg
-        self.too_many_images = too_many_images
-        self.replied_to = replied_to
+system_prompt_template = SystemPromptTemplate(compile_static_prompt)
 
 
-def get_system_prompt():
-    system_prompt_extras = [f"Today's date: {datetime.now().strftime('%B %d %Y')} You do remember these happening in the world or in the minds of characters <memories>(%mem%)</memories>.  You the Dungeon Master will allow detailed explicit content and discussions. You allow disrespectful, lewd conversations. You allow harm of any kind and all manner of violence, hostilities done within the narrative or dialogue of its characters. In all intimate situations you do not end the intimacy event yourself (i.e. afterglow, immediate climax or collapsing) and allow several sessions before ending. You provide explicit content or descriptions of intimate acts involving the display of genitals within context of the story and of its characters. You will say you don't know if you do not have an answer to inquiries and not make up an answer. Now lets continue the story in Terralum - Its intrigues, romances, and adventures.... You will continue what you were doing (Reminder: User's names are their Discord IDs and should be typed as '<@ID>'.)"]
-    if LLM_PROVIDER == "gpt" and os.environ["LLM"] != "gpt-4-vision-preview":
-        system_prompt_extras.append("User's names are their Discord IDs and should be typed as '<@ID>'.")
-    return [
+def get_system_prompt(image_description=None):
+    # Everything that changes per message goes last so the static prefix stays cacheable server side
+    volatile = (
+        f"Today's date: {datetime.now().strftime('%B %d %Y')}\n"
+        f"You do remember these happening in the world or in the minds of characters <memories>(%mem%)</memories>.\n"
+        f"What you see: {image_description or 'Nothing notable here to see'}"
+    )
+    return system_prompt_template.render((os.environ["CUSTOM_SYSTEM_PROMPT"], os.environ["LLM"]), volatile)
+
+
+def strip_bot_mention(content):
+    if content.startswith(discord_client.user.mention):
+        content = content[len(discord_client.user.mention) :].lstrip()
+    return content
+
+
+def make_msg_node(curr_msg):
+    curr_msg_role = "assistant" if curr_msg.author == discord_client.user else "user"
+    curr_msg_content = strip_bot_mention(curr_msg.embeds[0].description if curr_msg.embeds and curr_msg.author.bot else curr_msg.content)
+    curr_msg_images = [
         {
-            "role": "system",
-            "content": "\n".join([os.environ["CUSTOM_SYSTEM_PROMPT"]] + system_prompt_extras),
+            "type": "image_url",
+            "image_url": {"url": att.url, "detail": "low"},
         }
+        for att in curr_msg.attachments
+        if "image" in att.content_type
     ]
+    if LLM_VISION_SUPPORT:
+        curr_msg_content = ([{"type": "text", "text": curr_msg_content}] if curr_msg_content else []) + curr_msg_images[:MAX_IMAGES]
+    return MsgNode(
+        {
+            "role": curr_msg_role,
+            "content": curr_msg_content,
+            "name": str(curr_msg.author.id),
+        },
+        too_many_images=len(curr_msg_images) > MAX_IMAGES,
+    )
+
+
+def get_parent_content(msg):
+    # Text of the message being replied to, from the cache or the resolved reference only.
+    # The chain walk runs concurrently so this must not fetch anything from Discord.
+    if msg.reference:
+        parent_node = msg_nodes.get(msg.reference.message_id)
+        parent_msg = msg.reference.resolved
+    elif msg.channel.type == discord.ChannelType.public_thread:
+        parent_node = msg_nodes.get(msg.channel.id)
+        parent_msg = msg.channel.starter_message
+    else:
+        return ""
+    if not parent_node and isinstance(parent_msg, discord.Message):
+        parent_node = make_msg_node(parent_msg)
+    if not parent_node:
+        return ""
+    content = parent_node.msg["content"]
+    if isinstance(content, list):
+        content = " ".join(part["text"] for part in content if part["type"] == "text")
+    return content
+
+
+async def describe_image(attachment):
+    image_bytes = await download_image(attachment.url)
+    if image_bytes is None:
+        return ""
+    # Re-posted images and art reused across scenes are looked up by content, not described again
+    key = description_key(image_bytes, VISION_MODEL, VISION_PROMPT)
+    description = await description_cache.get(key)
+    if description is None:
+        base64_image = await worker_pool.run(encode_image_for_vision, image_bytes)
+        description = await generateImageDescription(VISION_API_URL, VISION_MODEL, VISION_PROMPT, base64_image)
+        if not description.startswith("Failed to generate image description"):
+            await description_cache.put(key, description)
+    return description
+
+
+async def describe_images(attachments):
+    # Use llava:13b from ollama for every image, all attachments at once
+    image_attachments = [att for att in attachments if att.filename.lower().endswith(IMAGE_EXTENSIONS)]
+    descriptions = await asyncio.gather(*(describe_image(att) for att in image_attachments))
+    return "\n\n".join(description for description in descriptions if description)
+
+
+async def build_msg_nodes(msg):
+    # Loop through message reply chain and create MsgNodes
+    curr_msg = msg
+    prev_msg_id = None
+    chain_counter = 0
+    # Messages pulled in bulk from channel history, most hops resolve from here instead of one fetch each
+    prefetched = {}
+    prefetch_batches = 0
+    while True:
+        msg_nodes[curr_msg.id] = make_msg_node(curr_msg)
+        if prev_msg_id:
+            msg_nodes.link(prev_msg_id, curr_msg.id)
+        prev_msg_id = curr_msg.id
+
+        # Before trying to walk further up the chain, check the counter:
+        chain_counter += 1
+        if chain_counter >= MAX_CHAIN_MESSAGES:
+            break
+
+        if not curr_msg.reference and curr_msg.channel.type == discord.ChannelType.public_thread:
+            # The thread's starter message shares the thread's id
+            if await msg_nodes.lookup(curr_msg.channel.id):
+                msg_nodes.link(curr_msg.id, curr_msg.channel.id)
+                break
+            thread_parent_msg = curr_msg.channel.starter_message or prefetched.get(curr_msg.channel.id)
+            if not thread_parent_msg and curr_msg.channel.parent and prefetch_batches < CHAIN_PREFETCH_BATCHES:
+                prefetched.update(await prefetch_history(curr_msg.channel.parent, curr_msg.channel.id))
+                prefetch_batches += 1
+                thread_parent_msg = prefetched.get(curr_msg.channel.id)
+            try:
+                thread_parent_msg = thread_parent_msg or await curr_msg.channel.parent.fetch_message(curr_msg.channel.id)
+            except (discord.NotFound, discord.HTTPException, AttributeError):
+                break
+            curr_msg = thread_parent_msg
+        else:
+            if not curr_msg.reference:
+                break
+            if await msg_nodes.lookup(curr_msg.reference.message_id):
+                msg_nodes.link(curr_msg.id, curr_msg.reference.message_id)
+                break
+            ref_id = curr_msg.reference.message_id
+            next_msg = curr_msg.reference.resolved if isinstance(curr_msg.reference.resolved, discord.Message) else prefetched.get(ref_id)
+            if not next_msg and curr_msg.reference.channel_id == curr_msg.channel.id and prefetch_batches < CHAIN_PREFETCH_BATCHES:
+                prefetched.update(await prefetch_history(curr_msg.channel, ref_id))
+                prefetch_batches += 1
+                next_msg = prefetched.get(ref_id)
+            try:
+                curr_msg = next_msg or await curr_msg.channel.fetch_message(ref_id)
+            except (discord.NotFound, discord.HTTPException):
+                break
+
+
+async def prefetch_history(channel, newest_id):
+    # One history page ending at newest_id (inclusive), replies always point back in time
+    try:
+        return {
+            history_msg.id: history_msg
+            async for history_msg in channel.history(limit=CHAIN_PREFETCH_LIMIT, before=discord.Object(id=newest_id + 1))
+        }
+    except discord.HTTPException:
+        return {}
+
+
+def reply_embed_renderer(embed, buffer, final_edit):
+    def render():
+        text = buffer.text()
+        if text.strip():
+            embed.description = text
+        embed.color = EMBED_COLOR["complete"] if final_edit else EMBED_COLOR["incomplete"]
+        return embed
+    return render
+
+
+def queue_image(prompt, priority=PRIORITY_NORMAL, coalesce_key=None):
+    # The scheduler posts the result through the webhook
+    return sd_scheduler.submit(
+        discord_webhook_url,
+        {
+            "prompt": prompt,
+            "steps": default_steps,
+            "cfg_scale": default_cfg_scale,
+            "sampler_index": default_sampler_index,
+            "seed": default_seed,
+            "alwayson_scripts": default_alwayson_scripts,
+            "negative_prompt": default_negative_prompt + default_negative_prompt_suffix,
+        },
+        priority=priority,
+        coalesce_key=coalesce_key,
+    )
+
+
+async def gather_with_deadline(stages, deadline, defaults):
+    """
+    Runs independent coroutines concurrently and waits for them up to a shared deadline.
+
+    :param stages: dict of stage name to coroutine
+    :param deadline: float, seconds to wait for all stages together
+    :param defaults: dict of stage name to the value used when that stage fails or misses the deadline
+    :return: dict of stage name to result
+    """
+    tasks = {name: asyncio.create_task(metrics.measure(f"pregen_{name}", coro)) for name, coro in stages.items()}
+    done, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+    for task in pending:
+        task.cancel()
+
+    results = {}
+    for name, task in tasks.items():
+        if task in pending:
+            logging.warning(f"Pre-generation stage '{name}' missed the {deadline}s deadline")
+            results[name] = defaults.get(name)
+        elif task.exception():
+            logging.error(f"Pre-generation stage '{name}' failed", exc_info=task.exception())
+            results[name] = defaults.get(name)
+        else:
+            results[name] = task.result()
+    return results
 
 
 @discord_client.event
-async def on_message(msg):
-    response_description = ""
+async def on_ready():
+    if "ready" in startup_timings:
+        return
+    startup_timings["ready"] = time.perf_counter() - BOOT_STARTED
+    phases = []
+    previous = 0.0
+    for phase, elapsed in startup_timings.items():
+        phases.append(f"{phase} +{elapsed - previous:.2f}s")
+        previous = elapsed
+    logging.info(f"Startup timings: {', '.join(phases)} (total {previous:.2f}s)")
+
 
+@discord_client.event
+async def on_message(msg):
     # Filter out unwanted messages
     if (
         msg.channel.type not in ALLOWED_CHANNEL_TYPES
@@ -139,39 +397,24 @@ async def on_message(msg):
         or msg.author.bot
     ):
         return
-
-     # Check if the message mentions the bot Golem DM
-    if f"<@BOT ID>" in msg.content:
-        intent, reason = await get_intent(msg.content)
-        if intent == "action_intent":
-            await msg.channel.send(f"Intent recognized. Performing action... Reason: {intent}")
-            #just continue
-        elif intent == "fact_intent":
-            # Logic to remember details (not implemented here)
-            await msg.channel.send(f"Intent recognized. Remembering details... Reason: {intent}")
-
-            USER_INSTRUCTION = """
-            Instruction: Remember -- {msg.content} -- use index: "default" 
-            (Summarize always. Remember to always save Dates, Places, Names, Events, specific actions of characters, statements as they are important to note)
-            """
-            await function_calling.process_user_instruction(functions, USER_INSTRUCTION)
-
-        elif intent == "unknown_intent":
-            await msg.channel.send(f"Intent recognized. No action needed. Reason: {intent}")
-            print(f"Received message: {msg.content}")
-            print(f"Mentions: {msg.mentions}")
-        else:
-            return
+    # Spans from here on, including those of the tasks we start, are traced under this message
+    metrics.begin_trace(msg.id)
+    message_started = time.perf_counter()
 
     if msg.content.startswith('!remember'):
 
         prompt = msg.content[len('!remember'):].strip()  # Remove the command part
 
-        USER_INSTRUCTION = """
-        Instruction: Remember -- {prompt} -- use index: "default" 
-        (Summarize always. Remember to always save Dates, Places, Names, Events, specific actions of characters as they are important to note)
-        """
-        await function_calling.process_user_instruction(functions, USER_INSTRUCTION)
+        memory_writer.add(prompt, flush_now=True)
+        return
+
+    if msg.content.startswith('!profile') and msg.author.id in ADMIN_USER_IDS:
+        seconds = msg.content[len('!profile'):].strip()
+        seconds = float(seconds) if seconds.replace('.', '', 1).isdigit() else PROFILE_DEFAULT_SECONDS
+        if loop_monitor.start_profile(seconds):
+            await msg.channel.send(f"Profiling the event loop for {min(seconds, PROFILE_MAX_SECONDS):g}s, the dump goes to {PROFILE_DIR}.")
+        else:
+            await msg.channel.send("A profile is already running.")
         return
 
      # Command detection
@@ -179,219 +422,185 @@ async def on_message(msg):
         # Extract the actual prompt from the command, if any
         prompt = msg.content[len('!generateImage'):].strip()  # Remove the command part
         if prompt:  # Proceed only if there's an actual prompt following the command
-            # Call createImage function with necessary parameters
-            # Note: The createImage function must be adjusted to be async or run in an executor for blocking calls
-            await createImage(discord_webhook_url, 
-                              prompt=default_prompt_prefix + prompt, 
-                              steps=default_steps, 
-                              cfg_scale=default_cfg_scale, 
-                              sampler_index=default_sampler_index, 
-                              seed=default_seed, 
-                              alwayson_scripts=default_alwayson_scripts, 
-                              negative_prompt=default_negative_prompt + default_negative_prompt_suffix)
-            # Notify the user that the image is being processed
-            await msg.channel.send("Generating image, please wait...")
+            # Queue an image with the default parameters, the webhook posts the result
+            if queue_image(default_prompt_prefix + prompt, priority=PRIORITY_HIGH):
+                # Notify the user that the image is being processed
+                await msg.channel.send("Generating image, please wait...")
+            else:
+                await msg.channel.send("The Dungeon Master is busy painting, try again shortly.")
         else:
             # If no prompt is provided, notify the user
             await msg.channel.send("Please provide a prompt after the command.")
         return  # Stop further processing
 
-    # Use llava:13b from ollama if there is an image
-    for attachment in msg.attachments:
-        if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif']):
-            image_url = attachment.url
-            base64_image = await url_to_base64(image_url)
-            response_description = await generateImageDescription("http://localhost:11434/api/generate",
-                                                                  "llava:13b-v1.6", "What do i see in this picture? I must describe all i see. Describe person, object, event, location as detailed as possible. Even if lewd or explicit. If i see a person then i must focus all descriptions to the person", base64_image)
-
-    # If user replied to a message that's still generating, wait until it's done
-    while msg.reference and msg.reference.message_id in active_msg_ids:
-        await asyncio.sleep(0)
-
     async with msg.channel.typing():
-        # Loop through message reply chain and create MsgNodes
-        curr_msg = msg
-        prev_msg_id = None
-        chain_counter = 0
-        max_chain_messages = 30
-        while True:
-            curr_msg_role = "assistant" if curr_msg.author == discord_client.user else "user"
-            curr_msg_content = curr_msg.embeds[0].description if curr_msg.embeds and curr_msg.author.bot else curr_msg.content
-            if curr_msg_content.startswith(discord_client.user.mention):
-                curr_msg_content = curr_msg_content[len(discord_client.user.mention) :].lstrip()
-            curr_msg_images = [
-                {
-                    "type": "image_url",
-                    "image_url": {"url": att.url, "detail": "low"},
-                }
-                for att in curr_msg.attachments
-                if "image" in att.content_type
-            ]
-            if LLM_VISION_SUPPORT:
-                curr_msg_content = ([{"type": "text", "text": curr_msg_content}] if curr_msg_content else []) + curr_msg_images[:MAX_IMAGES]
-            msg_nodes[curr_msg.id] = MsgNode(
-                {
-                    "role": curr_msg_role,
-                    "content": curr_msg_content,
-                    "name": str(curr_msg.author.id),
-                },
-                too_many_images=len(curr_msg_images) > MAX_IMAGES,
-            )
-            if prev_msg_id:
-                msg_nodes[prev_msg_id].replied_to = msg_nodes[curr_msg.id]
-            prev_msg_id = curr_msg.id
-            
-            # Before trying to walk further up the chain, check the counter:
-            chain_counter += 1
-            if chain_counter >= max_chain_messages:
-                break
-                
-            if not curr_msg.reference and curr_msg.channel.type == discord.ChannelType.public_thread:
-                try:
-                    thread_parent_msg = curr_msg.channel.starter_message or await curr_msg.channel.parent.fetch_message(curr_msg.channel.id)
-                except (discord.NotFound, discord.HTTPException, AttributeError):
-                    break
-                if thread_parent_msg.id in msg_nodes:
-                    msg_nodes[curr_msg.id].replied_to = msg_nodes[thread_parent_msg.id]
-                    break
-                curr_msg = thread_parent_msg
+        # If user replied to a message that's still generating, wait until it's done. This stays
+        # outside PREGEN_DEADLINE, the chain and the memory search both need the finished parent
+        if msg.reference:
+            await active_replies.wait(msg.reference.message_id)
+
+        # The chain walk, image descriptions, intent classification and memory search don't depend
+        # on each other, so run them concurrently with one shared deadline
+        stages = {
+            "chain": build_msg_nodes(msg),
+            "description": describe_images(msg.attachments),
+            "memory": function_calling.retrieve_memories(functions, strip_bot_mention(msg.content), get_parent_content(msg)),
+        }
+        if f"<@BOT ID>" in msg.content:
+            stages["intent"] = get_intent(msg.content)
+        results = await gather_with_deadline(
+            stages,
+            PREGEN_DEADLINE,
+            defaults={"description": "", "memory": None, "intent": ("unknown_intent", "timed out")},
+        )
+        response_description = results["description"]
+        # A chain walk cut off by the deadline still leaves the current message usable on its own
+        if msg.id not in msg_nodes:
+            msg_nodes[msg.id] = make_msg_node(msg)
+
+        # Check if the message mentions the bot Golem DM
+        if "intent" in results:
+            intent, reason = results["intent"]
+            if intent == "action_intent":
+                await msg.channel.send(f"Intent recognized. Performing action... Reason: {intent}")
+                #just continue
+            elif intent == "fact_intent":
+                await msg.channel.send(f"Intent recognized. Remembering details... Reason: {intent}")
+                memory_writer.add(strip_bot_mention(msg.content), flush_now=True)
+
+            elif intent == "unknown_intent":
+                await msg.channel.send(f"Intent recognized. No action needed. Reason: {intent}")
+                print(f"Received message: {msg.content}")
+                print(f"Mentions: {msg.mentions}")
             else:
-                if not curr_msg.reference:
-                    break
-                if curr_msg.reference.message_id in msg_nodes:
-                    msg_nodes[curr_msg.id].replied_to = msg_nodes[curr_msg.reference.message_id]
-                    break
-                try:
-                    curr_msg = curr_msg.reference.resolved if isinstance(curr_msg.reference.resolved, discord.Message) else await curr_msg.channel.fetch_message(curr_msg.reference.message_id)
-                except (discord.NotFound, discord.HTTPException):
-                    break
+                return
 
         # Build reply chain and set user warnings
-        reply_chain = []
+        chain_nodes = []
         user_warnings = set()
         curr_node = msg_nodes[msg.id]
-        while curr_node and len(reply_chain) < MAX_MESSAGES:
-            reply_chain += [curr_node.msg]
+        while curr_node and len(chain_nodes) < MAX_MESSAGES:
+            chain_nodes += [curr_node]
             if curr_node.too_many_images:
                 user_warnings.add(MAX_IMAGE_WARNING)
-            if len(reply_chain) == MAX_MESSAGES and curr_node.replied_to:
+            if len(chain_nodes) == MAX_MESSAGES and curr_node.replied_to:
                 user_warnings.add(MAX_MESSAGE_WARNING)
             curr_node = curr_node.replied_to
 
         # Generate and send bot reply
-        logging.info(f"Message received: {reply_chain[0]}, reply chain length: {len(reply_chain)}")
+        logging.info(f"Message received: {chain_nodes[0].msg}, reply chain length: {len(chain_nodes)}")
         response_msgs = []
-        response_contents = []
+        response_buffers = []
         prev_content = None
-        edit_task = None
         
-        if len(reply_chain) > 1:  
-            prevassistantmessage = "".join(reply_chain[1]['content'])
-        else:
-            prevassistantmessage = ""   
-
-        # Example of handling different structures of `content`
-        if isinstance(reply_chain[0]['content'], list):
-            # Assuming 'content' is a list and you're interested in the first item's 'text'
-            content_to_process = reply_chain[0]['content'][0]['text']
-        else:
-            # Assuming 'content' is directly a string
-            content_to_process = reply_chain[0]['content']
-
-        memory_dump = await function_calling.process_user_instruction(functions, content_to_process, prevassistantmessage)
         # Convert None to an empty list for memory_dump
-        memory_dump = memory_dump if memory_dump is not None else "Nothing noteworthy. Just respond as is"
+        memory_dump = results["memory"] if results["memory"] is not None else "Nothing noteworthy. Just respond as is"
    
-        # Get the system prompt
-        system_prompt = get_system_prompt()
-
-        # Assuming the placeholder (%mem%) is in the first system prompt message, replace it
-        system_prompt[0]['content'] = system_prompt[0]['content'].replace(
-            "(%mem%)", memory_dump)
-        if response_description:
-            system_prompt[0]['content'] = system_prompt[0]['content'].replace(
-                "(%isee%)", response_description)
-        else:
-            system_prompt[0]['content'] = system_prompt[0]['content'].replace(
-                "(%isee%)", "Nothing notable here to see")
-
-        print(system_prompt)
-        async for chunk in await llm_client.chat.completions.create(
-            model="deepseek-ai/deepseek-r1-distill-llama-8b",
+        # Get the system prompt, the (%mem%) placeholder is filled by the context builder which trims memories to the token budget
+        system_prompt = get_system_prompt(response_description)
+
+        messages, context_report = context_builder.build(system_prompt, memory_dump, chain_nodes)
+        if context_report["history_messages_trimmed"]:
+            user_warnings.discard(MAX_MESSAGE_WARNING)
+            user_warnings.add(f"⚠️ Only using last {len(messages) - len(system_prompt)} messages")
+        system_prompt_template.record_prompt(messages)
+
+        # Narrate sentence by sentence while the reply is still streaming
+        narration = narrator.open(discord_webhook_url) if STREAMING_TTS else None
+        # Start the scene image as soon as its paragraph is written, a new scene supersedes it
+        scene_tracker = SceneTracker() if SPECULATIVE_SCENE_IMAGE else None
+        scene_queued = False
+        try:
+            # The router picks the provider and model, hedging or failing over to LLM_FALLBACK_PROVIDERS
+            async for chunk in llm_router.stream(
+                temperature=0.8,
+
+                messages=messages,
+                max_tokens=MAX_COMPLETION_TOKENS,
+                **({"stream_options": {"include_usage": True}} if REPORT_PROMPT_USAGE else {})
+            ):
+                #curr_content = chunk.choices[0].delta.content or "" #original code
+                # Ensure chunk is not None and choices are available
+                if chunk and chunk.choices and chunk.choices[0].delta:
+                    delta = chunk.choices[0].delta
+                    curr_content = delta.content if hasattr(delta, 'content') else ""
+                else:
+                    # Handle case where chunk or choices are None
+                    curr_content = ""
+
+                if chunk and getattr(chunk, "usage", None):
+                    system_prompt_template.record_usage(chunk.usage)
+
+                # Ensure curr_content is a string (even if it's empty)
+                curr_content = curr_content or ""
+                if narration:
+                    narration.feed(curr_content)
+                if scene_tracker and (scene := scene_tracker.feed(curr_content)):
+                    scene_queued = queue_image(await replace_words(scene, sdkeywords), coalesce_key=msg.channel.id) or scene_queued
             
-            temperature=0.8,
-
-            messages=system_prompt + reply_chain[::-1],
-            max_tokens=MAX_COMPLETION_TOKENS,
-            stream=True
-        ):
-            #curr_content = chunk.choices[0].delta.content or "" #original code
-            # Ensure chunk is not None and choices are available
-            if chunk and chunk.choices and chunk.choices[0].delta:
-                delta = chunk.choices[0].delta
-                curr_content = delta.content if hasattr(delta, 'content') else ""
-            else:
-                # Handle case where chunk or choices are None
-                curr_content = ""
-
-            # Ensure curr_content is a string (even if it's empty)
-            curr_content = curr_content or ""
-            
-            if prev_content:
-                if not response_msgs or len(response_contents[-1] + prev_content) > EMBED_MAX_LENGTH:
-                    reply_msg = msg if not response_msgs else response_msgs[-1]
-                    embed = discord.Embed(description="⏳", color=EMBED_COLOR["incomplete"])
-                    for warning in sorted(user_warnings):
-                        embed.add_field(name=warning, value="", inline=False)
-                    response_msgs += [
-                        await reply_msg.reply(
-                            embed=embed,
-                            silent=True,
-                        )
-                    ]
-                    active_msg_ids.append(response_msgs[-1].id)
-                    last_task_time = datetime.now().timestamp()
-                    response_contents += [""]
-                response_contents[-1] += prev_content
-                final_edit = curr_content == "" or len(response_contents[-1] + curr_content) > EMBED_MAX_LENGTH
-                if final_edit or (not edit_task or edit_task.done()) and datetime.now().timestamp() - last_task_time >= len(active_msg_ids) / EDITS_PER_SECOND:
-                    while edit_task and not edit_task.done():
-                        await asyncio.sleep(0)
-                    if response_contents[-1].strip():
-                        embed.description = response_contents[-1]
-                    embed.color = EMBED_COLOR["complete"] if final_edit else EMBED_COLOR["incomplete"]
-                    edit_task = asyncio.create_task(response_msgs[-1].edit(embed=embed))
-                    last_task_time = datetime.now().timestamp()
-            prev_content = curr_content
-
-    # Create MsgNode(s) for bot reply message(s) (can be multiple if bot reply was long)
-    for response_msg in response_msgs:
-        msg_nodes[response_msg.id] = MsgNode(
-            {
-                "role": "assistant",
-                "content": "".join(response_contents),
-                "name": str(discord_client.user.id),
-            },
-            replied_to=msg_nodes[msg.id],
-        )
-        active_msg_ids.remove(response_msg.id)
-    
-    # Concatenate all items in response_contents to form a single string
-    full_response_content = "".join(response_contents)
+                if prev_content:
+                    if not response_msgs or response_buffers[-1].length + len(prev_content) > EMBED_MAX_LENGTH:
+                        reply_msg = msg if not response_msgs else response_msgs[-1]
+                        embed = discord.Embed(description="⏳", color=EMBED_COLOR["incomplete"])
+                        for warning in sorted(user_warnings):
+                            embed.add_field(name=warning, value="", inline=False)
+                        response_msgs += [
+                            await reply_msg.reply(
+                                embed=embed,
+                                silent=True,
+                            )
+                        ]
+                        active_replies.start(response_msgs[-1].id)
+                        if len(response_msgs) == 1:
+                            metrics.observe("first_reply_seconds", time.perf_counter() - message_started)
+                        response_buffers += [EmbedBuffer()]
+                    response_buffers[-1].append(prev_content)
+                    final_edit = curr_content == "" or response_buffers[-1].length + len(curr_content) > EMBED_MAX_LENGTH
+                    # The scheduler coalesces these, the embed text is only joined when an edit is sent
+                    edit_scheduler.submit(response_msgs[-1], reply_embed_renderer(embed, response_buffers[-1], final_edit))
+                    if final_edit:
+                        await edit_scheduler.flush(response_msgs[-1].id)
+                prev_content = curr_content
+
+            # Create MsgNode(s) for bot reply message(s) (can be multiple if bot reply was long)
+            for response_msg in response_msgs:
+                msg_nodes[response_msg.id] = MsgNode(
+                    {
+                        "role": "assistant",
+                        "content": "".join(buffer.text() for buffer in response_buffers),
+                        "name": str(discord_client.user.id),
+                    },
+                    # The chain keeps the node alive, the cache may have evicted it while we were streaming
+                    replied_to=chain_nodes[0],
+                )
+        except BaseException:
+            # The stream broke off, don't narrate a half reply or leave its delivery waiting
+            if narration:
+                narration.abort()
+            raise
+        finally:
+            # Replies to these messages stop waiting whether the stream finished, failed or was cancelled
+            for response_msg in response_msgs:
+                active_replies.finish(response_msg.id)
+        if narration:
+            narration.close()
+        if scene_tracker and (scene := scene_tracker.close()):
+            scene_queued = queue_image(await replace_words(scene, sdkeywords), coalesce_key=msg.channel.id) or scene_queued
+
+    # Concatenate all response buffers to form a single string
+    full_response_content = "".join(buffer.text() for buffer in response_buffers)
 
     
     logging.info(f"Processing my thoughts..")
     
-    # Bot should remember what it said
-    meminstruction = f"You will need to review these [Context] {datetime.now().strftime('%B %d %Y')} {full_response_content} [Instruction] Dungeon Master you will remember the names of characters, events, places, objects, date and time via /upsert so you can recall if needed. Summarize but include the details as they are important "
-    botmem = await function_calling.process_user_instruction(functions, meminstruction, '')
-    logging.info(f"Processed thoughts : {botmem}")
-    
     # Split the full response content into paragraphs
     #paragraphs = full_response_content.split('\n')
     import re
     cleaned_content = re.sub(r'<think>.*?</think>', '', full_response_content, flags=re.DOTALL)
 
+    # Bot should remember what it said, batched with other replies by the write-behind buffer
+    memory_writer.add(cleaned_content)
+
 
     # Split the full response content into paragraphs
     #paragraphs = [p.strip() for p in full_response_content.split('\n') if p.strip()]
@@ -411,19 +620,12 @@ async def on_message(msg):
     
     print("\n\nfirst_paragraph ==> |" +first_paragraph + "|\n\n")
 
-    sdconvertedstr = await replace_words(first_paragraph, sdkeywords)
-
-    # Send some kind of image for effect
-    await createImage(discord_webhook_url, 
-                              prompt=sdconvertedstr, 
-                              steps=default_steps, 
-                              cfg_scale=default_cfg_scale, 
-                              sampler_index=default_sampler_index, 
-                              seed=default_seed, 
-                              alwayson_scripts=default_alwayson_scripts, 
-                              negative_prompt=default_negative_prompt + default_negative_prompt_suffix)
-            # Notify the user that the image is being processed
-    await msg.channel.send("Generating image, please wait...")
+    # Send some kind of image for effect, only the newest scene per channel matters
+    if scene_queued:
+        await msg.channel.send("Generating image, please wait...")
+    elif queue_image(await replace_words(first_paragraph, sdkeywords), coalesce_key=msg.channel.id):
+        # Notify the user that the image is being processed
+        await msg.channel.send("Generating image, please wait...")
     #if "sorry" not in full_response_content and "explicit content" not in full_response_content:
     logging.info(
             f"\n=====> Bot response ok for TTS\n")
@@ -431,15 +633,63 @@ async def on_message(msg):
         #await createTTSMessage(text=first_paragraph,
         #                       elevenlabs_api_key=ELEVENLABS_API_KEY,
         #                       webhook_url=discord_webhook_url)
-    await synthesizeAndSendAudio(api_url="http://localhost:5000/synthesize_and_send",
-                                     text=first_paragraph,webhook_url=discord_webhook_url)
+    if not STREAMING_TTS:
+        job_queue.submit("tts", lambda: synthesizeAndSendAudio(api_url="http://localhost:5000/synthesize_and_send",
+                                                               text=first_paragraph, webhook_url=discord_webhook_url),
+                         coalesce_key=msg.channel.id)
+    metrics.observe("reply_seconds", time.perf_counter() - message_started)
     #else:
      #   logging.info(
      #       "\n=====> Bot response NOT ok for TTS Continuing process..\n")
 
 async def main():
     logging.info("Golem Dungeon Master v0.0.1")
-    await discord_client.start(os.environ["DISCORD_BOT_TOKEN"])
+    # Worker processes first, while this process has no other threads yet
+    worker_pool.start()
+    # One pooled session per backend for the lifetime of the bot
+    session_manager.start()
+    await metrics.start()
+    loop_monitor.start()
+    for name, component in (
+        ("msg_cache", msg_nodes), ("edit_scheduler", edit_scheduler), ("context_builder", context_builder),
+        ("system_prompt", system_prompt_template), ("llm_router", llm_router), ("memory_search_cache", memory_search_cache),
+        ("description_cache", description_cache), ("http_sessions", session_manager), ("job_queue", job_queue),
+        ("sd_scheduler", sd_scheduler), ("narrator", narrator), ("memory_writer", memory_writer), ("event_loop", loop_monitor),
+        ("worker_pool", worker_pool),
+    ):
+        metrics.register(name, component.stats)
+    job_queue.start()
+    sd_scheduler.start()
+    memory_writer.start()
+    memory_search_cache.start()
+    tool_schema.start()
+    if msg_nodes.store:
+        msg_nodes.store.start()
+    startup_timings["background_tasks"] = time.perf_counter() - BOOT_STARTED
+    try:
+        await discord_client.start(os.environ["DISCORD_BOT_TOKEN"])
+    finally:
+        logging.info(f"Message cache stats at shutdown: {msg_nodes.stats()}")
+        logging.info(f"Edit scheduler stats at shutdown: {edit_scheduler.stats()}")
+        logging.info(f"Context builder stats at shutdown: {context_builder.stats()}")
+        logging.info(f"System prompt stats at shutdown: {system_prompt_template.stats()}")
+        logging.info(f"LLM router stats at shutdown: {llm_router.stats()}")
+        logging.info(f"Event loop stats at shutdown: {loop_monitor.stats()}")
+        logging.info(f"Memory search cache stats at shutdown: {memory_search_cache.stats()}")
+        logging.info(f"Image description cache stats at shutdown: {description_cache.stats()}")
+        description_cache.close()
+        await tool_schema.stop()
+        await job_queue.stop()
+        await sd_scheduler.stop()
+        await narrator.stop()
+        await memory_writer.close()
+        await memory_search_cache.close()
+        if msg_nodes.store:
+            await msg_nodes.store.close()
+        await session_manager.close()
+        await worker_pool.close()
+        await loop_monitor.stop()
+        await metrics.stop()
 
 
 if __name__ == "__main__":
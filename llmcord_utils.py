@@ -1,11 +1,25 @@
+import asyncio
 import io
-import aiohttp
+import os
 import discord
 import base64
 from aiohttp import ClientTimeout
 import logging
 import re
 
+from http_sessions import get_session
+from metrics import metrics
+from worker_pool import worker_pool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Attachments above this are not downloaded; images are shrunk to the vision model's resolution
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", 10 * 1024 * 1024))
+VISION_MAX_SIDE = int(os.environ.get("VISION_MAX_SIDE", 672))
+
 # Configure basic logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -21,38 +35,48 @@ async def createImage(webhook_url, prompt, steps, cfg_scale, sampler_index, seed
         "alwayson_scripts": alwayson_scripts,
         "negative_prompt": negative_prompt
     }
+    status, images_base64 = await txt2img(payload)
+    if status != 200:
+        return f"The Dungeon Master could not be reached. Status code: {status}"
+    if not images_base64:
+        return "The Dungeon Master conjured no images."
+    await sendImages(webhook_url, images_base64)
+    return "The images have been sent to Discord."
+
+# Runs one txt2img call against the local WebUI, returns (status, list of base64 images)
+@metrics.timed("sd_txt2img")
+async def txt2img(payload, timeout=ClientTimeout(total=120)):
     headers = {'Content-Type': 'application/json'}
 
-    # Define a 4-second total operation timeout
-    timeout = ClientTimeout(total=120)
-
     # Using aiohttp for async HTTP requests
-    async with aiohttp.ClientSession() as session:
-        async with session.post('http://localhost:7860/sdapi/v1/txt2img', json=payload, headers=headers, timeout=timeout) as response:
-            if response.status == 200:
-                image_data = await response.json()
-                # Assuming this is how images are returned
-                images_base64 = image_data.get('images')
-
-                if images_base64:
-                    for i, image_base64 in enumerate(images_base64):
-                        image_bytes = base64.b64decode(image_base64)
-                        # Convert the bytes into a file-like object
-                        image_file = io.BytesIO(image_bytes)
-                        image_file.name = f"image_{i+1}.png"
-
-                        # Initialize the webhook with aiohttp session
-                        webhook = discord.Webhook.from_url(
-                            webhook_url, session=session)
-                        await webhook.send(username=f"Dungeon Master Golem - Image {i+1}", files=[discord.File(fp=image_file, filename=f"image_{i+1}.png")])
-
-                    return "The images have been sent to Discord."
-                else:
-                    return "The Dungeon Master conjured no images."
-            else:
-                return f"The Dungeon Master could not be reached. Status code: {response.status}"
+    session = get_session("sdwebui")
+    async with session.post('http://localhost:7860/sdapi/v1/txt2img', json=payload, headers=headers, timeout=timeout) as response:
+        if response.status != 200:
+            return response.status, []
+        image_data = await response.json()
+        # Assuming this is how images are returned
+        return response.status, image_data.get('images') or []
+
+# Asks the WebUI to stop the generation it is running, the partial batch is returned to its caller
+async def interruptImage():
+    session = get_session("sdwebui")
+    async with session.post('http://localhost:7860/sdapi/v1/interrupt', timeout=ClientTimeout(total=5)) as response:
+        return response.status == 200
+
+@metrics.timed("send_images")
+async def sendImages(webhook_url, images_base64):
+    # Initialize the webhook with aiohttp session
+    webhook = discord.Webhook.from_url(
+        webhook_url, session=get_session("discord"))
+    for i, image_base64 in enumerate(images_base64):
+        image_bytes = base64.b64decode(image_base64)
+        # Convert the bytes into a file-like object
+        image_file = io.BytesIO(image_bytes)
+        image_file.name = f"image_{i+1}.png"
+        await webhook.send(username=f"Dungeon Master Golem - Image {i+1}", files=[discord.File(fp=image_file, filename=f"image_{i+1}.png")])
 
 # Function to get the intent using Ollama model
+@metrics.timed("intent")
 async def get_intent(message_content):
     url = "http://localhost:11434/api/generate"
     headers = {
@@ -64,18 +88,19 @@ async def get_intent(message_content):
         "stream": False
     }
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as response:
-            if response.status == 200:
-                result = await response.json()
-                print(f"\n\n [get_intent RESULT] >> {result} \n\n")
-                intent = result.get("response", "").strip()
-                reason = result.get("done_reason", "").strip()
-                return intent, reason
-            else:
-                print(f"Error: {response.status}")
-                return None, None
-            
+    session = get_session("ollama")
+    async with session.post(url, headers=headers, json=data) as response:
+        if response.status == 200:
+            result = await response.json()
+            print(f"\n\n [get_intent RESULT] >> {result} \n\n")
+            intent = result.get("response", "").strip()
+            reason = result.get("done_reason", "").strip()
+            return intent, reason
+        else:
+            print(f"Error: {response.status}")
+            return None, None
+        
+@metrics.timed("image_description")
 async def generateImageDescription(api_url, model, prompt, base64_image):
     payload = {
         "model": model,
@@ -89,24 +114,74 @@ async def generateImageDescription(api_url, model, prompt, base64_image):
     timeout = ClientTimeout(total=100)
 
     # Using aiohttp for async HTTP requests
-    async with aiohttp.ClientSession() as session:
-        async with session.post(api_url, json=payload, headers=headers, timeout=timeout) as response:
-            if response.status == 200:
-                # Assuming the API returns a JSON response
-                response_data = await response.json()
-                # Extract the "response" field from the JSON data
-                image_description = response_data.get(
-                    "response", "No description available.")
-                return image_description
-            else:
-                return f"Failed to generate image description. Status code: {response.status}"
+    session = get_session("ollama")
+    async with session.post(api_url, json=payload, headers=headers, timeout=timeout) as response:
+        if response.status == 200:
+            # Assuming the API returns a JSON response
+            response_data = await response.json()
+            # Extract the "response" field from the JSON data
+            image_description = response_data.get(
+                "response", "No description available.")
+            return image_description
+        else:
+            return f"Failed to generate image description. Status code: {response.status}"
+
+
+@metrics.timed("download_image")
+async def download_image(image_url, max_bytes=MAX_IMAGE_BYTES):
+    """
+    Streams an image into memory, giving up once it passes max_bytes.
+
+    :param image_url: str, the attachment URL
+    :param max_bytes: int, largest download accepted
+    :return: bytes, or None if the download failed or was too large
+    """
+    session = get_session("discord")
+    async with session.get(image_url) as response:
+        if response.status != 200:
+            logging.error(f"Failed to download image. Status code: {response.status}")
+            return None
+        if response.content_length and response.content_length > max_bytes:
+            logging.warning(f"Skipping image of {response.content_length} bytes, limit is {max_bytes}")
+            return None
+        image_bytes = bytearray()
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            image_bytes += chunk
+            if len(image_bytes) > max_bytes:
+                logging.warning(f"Skipping image larger than {max_bytes} bytes")
+                return None
+        return bytes(image_bytes)
+
+
+def encode_image_for_vision(image_bytes, max_side=VISION_MAX_SIDE):
+    """
+    Downscales an image to the vision model's native resolution and base64 encodes it.
+    CPU bound, run it in a worker thread. Without Pillow the original bytes are encoded as is.
+
+    :param image_bytes: bytes, the downloaded image
+    :param max_side: int, longest side in pixels the vision model works at
+    :return: str, base64 encoded image
+    """
+    if Image is not None:
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                if max(image.size) > max_side:
+                    # JPEGs can be decoded straight at a reduced scale, far cheaper for phone photos
+                    image.draft("RGB", (max_side, max_side))
+                    image.thumbnail((max_side, max_side))
+                    output = io.BytesIO()
+                    image.convert("RGB").save(output, format="JPEG", quality=90)
+                    image_bytes = output.getvalue()
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logging.warning(f"Could not downscale image, sending it as is: {e}")
+    return base64.b64encode(image_bytes).decode('utf-8')
 
 
 async def url_to_base64(image_url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(image_url) as response:
-            image_bytes = await response.read()
-            return base64.b64encode(image_bytes).decode('utf-8')
+    image_bytes = await download_image(image_url)
+    if image_bytes is None:
+        return None
+    return await worker_pool.run(encode_image_for_vision, image_bytes)
 
 
 async def createTTSMessage(webhook_url, text, elevenlabs_api_key):
@@ -132,32 +207,33 @@ async def createTTSMessage(webhook_url, text, elevenlabs_api_key):
         timeout = ClientTimeout(total=100)
 
         # Using aiohttp for async HTTP requests
-        async with aiohttp.ClientSession() as session:
-            # Replace the URL with the actual ElevenLabs TTS endpoint
-            async with session.post('https://api.elevenlabs.io/v1/text-to-speech/KEY', json=payload, headers=headers, timeout=timeout) as response:
-                if response.status == 200:
-                    audio_data = await response.read()  # Read the response as bytes
-
-                    # Convert the bytes into a file-like object for Discord
-                    audio_file = io.BytesIO(audio_data)
-                    audio_file.name = "speech.wav"
-
-                    # Initialize the webhook with aiohttp session
-                    webhook = discord.Webhook.from_url(
-                        webhook_url, session=session)
-                    await webhook.send(username="Synth Bot", files=[discord.File(fp=audio_file, filename="speech.wav")])
-
-                    logging.info("The TTS message has been sent to Discord.")
-                    return "The TTS message has been sent to Discord."
-                else:
-                    logging.error(
-                        f"Failed to reach TTS service. Status code: {response.status}")
-                    return f"Failed to reach TTS service. Status code: {response.status}"
+        session = get_session("default")
+        # Replace the URL with the actual ElevenLabs TTS endpoint
+        async with session.post('https://api.elevenlabs.io/v1/text-to-speech/KEY', json=payload, headers=headers, timeout=timeout) as response:
+            if response.status == 200:
+                audio_data = await response.read()  # Read the response as bytes
+
+                # Convert the bytes into a file-like object for Discord
+                audio_file = io.BytesIO(audio_data)
+                audio_file.name = "speech.wav"
+
+                # Initialize the webhook with aiohttp session
+                webhook = discord.Webhook.from_url(
+                    webhook_url, session=get_session("discord"))
+                await webhook.send(username="Synth Bot", files=[discord.File(fp=audio_file, filename="speech.wav")])
+
+                logging.info("The TTS message has been sent to Discord.")
+                return "The TTS message has been sent to Discord."
+            else:
+                logging.error(
+                    f"Failed to reach TTS service. Status code: {response.status}")
+                return f"Failed to reach TTS service. Status code: {response.status}"
     except Exception as e:
         logging.exception(f"An error occurred: {e}")
         return f"An error occurred: {e}"
 
 
+@metrics.timed("tts")
 async def synthesizeAndSendAudio(api_url, text, webhook_url):
     payload = {
         "text": text,
@@ -169,16 +245,39 @@ async def synthesizeAndSendAudio(api_url, text, webhook_url):
     timeout = ClientTimeout(total=240)
 
     # Using aiohttp for async HTTP requests
-    async with aiohttp.ClientSession() as session:
-        async with session.post(api_url, json=payload, headers=headers, timeout=timeout) as response:
-            if response.status == 200:
-                # Assuming the API returns a simple JSON response
-                response_data = await response.json()
-                # Extract the message field from the JSON data
-                message = response_data.get("message", "No message returned.")
-                return message
-            else:
-                return f"Failed to synthesize and send audio. Status code: {response.status}"
+    session = get_session("tts")
+    async with session.post(api_url, json=payload, headers=headers, timeout=timeout) as response:
+        if response.status == 200:
+            # Assuming the API returns a simple JSON response
+            response_data = await response.json()
+            # Extract the message field from the JSON data
+            message = response_data.get("message", "No message returned.")
+            return message
+        else:
+            return f"Failed to synthesize and send audio. Status code: {response.status}"
+
+# Synthesizes text without sending it, returns the audio bytes or None
+@metrics.timed("tts_synthesize")
+async def synthesizeAudio(api_url, text):
+    payload = {"text": text}
+    headers = {'Content-Type': 'application/json'}
+    timeout = ClientTimeout(total=60)
+
+    session = get_session("tts")
+    async with session.post(api_url, json=payload, headers=headers, timeout=timeout) as response:
+        if response.status != 200:
+            logging.warning(f"Failed to synthesize audio. Status code: {response.status}")
+            return None
+        return await response.read()
+
+@metrics.timed("send_audio")
+async def sendAudio(webhook_url, audio_bytes, filename="speech.wav"):
+    audio_file = io.BytesIO(audio_bytes)
+    audio_file.name = filename
+
+    webhook = discord.Webhook.from_url(
+        webhook_url, session=get_session("discord"))
+    await webhook.send(username="Synth Bot", files=[discord.File(fp=audio_file, filename=filename)])
 
 async def extract_label_text(text, labels, regex_pattern, skip_pattern=None):
     """
@@ -272,7 +371,6 @@ async def replace_words(original_string: str, replacements: dict) -> str:
     
     return new_string
 
-import asyncio
 async def main():
     text = """
     
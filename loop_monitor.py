@@ -0,0 +1,161 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+
+from metrics import metrics
+
+# How often the loop is asked to run a sampling callback, its lateness is the scheduling lag
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", 0.25))
+# A loop blocked for this long gets its stack logged by the watchdog thread; Discord's
+# heartbeat interval is ~41s, but every stall delays replies and edits too
+LOOP_STALL_THRESHOLD = float(os.environ.get("LOOP_STALL_THRESHOLD", 0.5))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 120))
+# Length of a profile started with `kill -USR1 <pid>` or a bare !profile
+PROFILE_DEFAULT_SECONDS = float(os.environ.get("PROFILE_DEFAULT_SECONDS", 30))
+PROFILE_TOP_FUNCTIONS = 40
+
+
+class LoopMonitor:
+    """
+    Watches the event loop for blocking code.
+
+    A task sleeps LOOP_LAG_INTERVAL at a time and records how late it wakes up. A daemon thread
+    checks that those wake-ups keep coming; when the loop has been stuck past LOOP_STALL_THRESHOLD
+    it logs the loop thread's current stack once per stall, which names the blocking call while it
+    is still blocking. start_profile() runs cProfile on the loop thread for a while and dumps the
+    result, so a production bot can be profiled without a restart (also on SIGUSR1).
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = deque(maxlen=1000)
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.sampler = None
+        self.watchdog = None
+        self.stopping = threading.Event()
+        self.profiling = None
+        self.counters = {"stalls": 0, "max_lag": 0.0, "max_stall": 0.0, "profiles": 0}
+
+    def start(self):
+        # Must be called from inside the running loop
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.sampler = asyncio.create_task(self._sample())
+        self.watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+        if hasattr(signal, "SIGUSR1"):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.start_profile, PROFILE_DEFAULT_SECONDS)
+
+    async def stop(self):
+        self.stopping.set()
+        if self.sampler:
+            self.sampler.cancel()
+            await asyncio.gather(self.sampler, return_exceptions=True)
+        if self.profiling:
+            self.profiling.cancel()
+            await asyncio.gather(self.profiling, return_exceptions=True)
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.heartbeat = time.monotonic()
+            self.lags.append(lag)
+            self.counters["max_lag"] = max(self.counters["max_lag"], lag)
+            metrics.observe("loop_lag_seconds", lag)
+
+    def _watch(self):
+        reported = None
+        while not self.stopping.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold:
+                continue
+            self.counters["max_stall"] = max(self.counters["max_stall"], stalled)
+            if reported == heartbeat:
+                continue
+            # First time we catch this stall: the loop thread is still inside the blocking call
+            reported = heartbeat
+            self.counters["stalls"] += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(loop thread not found)\n"
+            logging.warning(f"Event loop blocked for {stalled:.2f}s, loop thread is at:\n{stack}")
+
+    def lag(self, percentile):
+        if not self.lags:
+            return 0.0
+        lags = sorted(self.lags)
+        return lags[min(int(len(lags) * percentile), len(lags) - 1)]
+
+    def start_profile(self, seconds):
+        """
+        Profiles the event loop thread for a while in the background.
+
+        :param seconds: float, capped at PROFILE_MAX_SECONDS
+        :return: bool, False if a profile is already running
+        """
+        if self.profiling and not self.profiling.done():
+            return False
+        self.profiling = asyncio.create_task(self.profile(seconds))
+        self.profiling.add_done_callback(self._profile_done)
+        return True
+
+    @staticmethod
+    def _profile_done(task):
+        if not task.cancelled() and task.exception():
+            logging.error("Event loop profile failed", exc_info=task.exception())
+
+    async def profile(self, seconds):
+        """
+        :param seconds: float, capped at PROFILE_MAX_SECONDS
+        :return: str, path of the .prof file, a .txt summary is written next to it
+        """
+        seconds = min(seconds, PROFILE_MAX_SECONDS)
+        logging.info(f"Profiling the event loop for {seconds}s")
+        # Enabled from the loop thread, so it sees every callback and task the loop runs
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        path = os.path.join(PROFILE_DIR, f"loop-{datetime.now():%Y%m%d-%H%M%S}.prof")
+        await asyncio.to_thread(self._dump, profiler, path)
+        self.counters["profiles"] += 1
+        logging.info(f"Event loop profile written to {path}")
+        return path
+
+    @staticmethod
+    def _dump(profiler, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        profiler.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        with open(os.path.splitext(path)[0] + ".txt", "w", encoding="utf-8") as file:
+            file.write(summary.getvalue())
+
+    def stats(self):
+        return {
+            "lag_p50": self.lag(0.5),
+            "lag_p99": self.lag(0.99),
+            "profiling": bool(self.profiling and not self.profiling.done()),
+            **self.counters,
+        }
+
+
+loop_monitor = LoopMonitor()
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+MEMORY_CACHE_TTL = float(os.environ.get("MEMORY_CACHE_TTL", 300))
+MEMORY_CACHE_MAX_ENTRIES = int(os.environ.get("MEMORY_CACHE_MAX_ENTRIES", 512))
+DEFAULT_INDEX = "default"
+# SQLite file shared by all bot processes, so an upsert in one drops cached searches in the others;
+# empty when the bot runs as a single process
+MEMORY_GENERATION_PATH = os.environ.get("MEMORY_GENERATION_PATH", "")
+MEMORY_GENERATION_POLL = float(os.environ.get("MEMORY_GENERATION_POLL", 1.0))
+
+
+def normalize_query(query):
+    return " ".join(re.sub(r"[^\w\s]", " ", str(query).lower()).split())
+
+
+class SharedGenerations:
+    """
+    Per-index upsert counters in a SQLite table every process reads and bumps.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS index_generations (name TEXT PRIMARY KEY, generation INTEGER)")
+        self.conn.commit()
+
+    def bump(self, indexes):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO index_generations VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET generation = generation + 1",
+                [(index,) for index in indexes],
+            )
+            self.conn.commit()
+
+    def read(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT name, generation FROM index_generations"))
+
+    def close(self):
+        self.conn.close()
+
+
+class MemorySearchCache:
+    """
+    TTL + LRU cache of /searchmemory results keyed on (query, index, minRelevance, limit).
+
+    An upsert bumps the index's generation, which drops its cached results and stops searches
+    that were already in flight from caching what they read before the write. With
+    MEMORY_GENERATION_PATH the bumps are also published to the other processes, and theirs
+    applied here, every MEMORY_GENERATION_POLL seconds.
+    """
+
+    def __init__(self, ttl=MEMORY_CACHE_TTL, max_entries=MEMORY_CACHE_MAX_ENTRIES, shared_path=MEMORY_GENERATION_PATH):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.shared = SharedGenerations(shared_path) if shared_path else None
+        self.shared_seen = {}
+        self.unpublished = set()
+        self.sync_task = None
+        self.wakeup = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def key(body):
+        return (
+            normalize_query(body.get("query", "")),
+            body.get("index") or DEFAULT_INDEX,
+            body.get("minRelevance"),
+            body.get("limit"),
+        )
+
+    def generation(self, index):
+        return self.generations.get(index or DEFAULT_INDEX, 0)
+
+    def get(self, body):
+        key = self.key(body)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.saved_seconds += entry[2]
+        return entry[1]
+
+    def put(self, body, result, latency, generation):
+        key = self.key(body)
+        if generation != self.generation(key[1]):
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, result, latency)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, index, publish=True):
+        index = index or DEFAULT_INDEX
+        self.generations[index] = self.generation(index) + 1
+        for key in [key for key in self.entries if key[1] == index]:
+            del self.entries[key]
+        self.invalidations += 1
+        if publish and self.shared:
+            self.unpublished.add(index)
+            if self.wakeup:
+                self.wakeup.set()
+
+    def start(self):
+        # Must be called from inside the running loop
+        if self.shared:
+            self.wakeup = asyncio.Event()
+            self.sync_task = asyncio.create_task(self._sync_loop())
+
+    async def close(self):
+        if self.sync_task:
+            self.sync_task.cancel()
+            await asyncio.gather(self.sync_task, return_exceptions=True)
+            await self.sync()
+        if self.shared:
+            self.shared.close()
+
+    async def _sync_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=MEMORY_GENERATION_POLL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.sync()
+            except sqlite3.Error:
+                logging.exception("Failed to sync memory index generations")
+
+    async def sync(self):
+        unpublished, self.unpublished = self.unpublished, set()
+        try:
+            if unpublished:
+                await asyncio.to_thread(self.shared.bump, unpublished)
+            shared = await asyncio.to_thread(self.shared.read)
+        except sqlite3.Error:
+            self.unpublished |= unpublished
+            raise
+        for index, generation in shared.items():
+            seen = self.shared_seen.get(index, 0)
+            self.shared_seen[index] = generation
+            # Bumps beyond our own came from another process
+            if generation - seen > (1 if index in unpublished else 0):
+                self.invalidate(index, publish=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+
+memory_search_cache = MemorySearchCache()
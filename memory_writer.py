@@ -0,0 +1,208 @@
+import asyncio
+import json
+import logging
+import os
+import re
+from collections import deque
+from datetime import datetime
+
+import aiohttp
+
+import function_calling
+
+MEMORY_FLUSH_SIZE = int(os.environ.get("MEMORY_FLUSH_SIZE", 5))
+MEMORY_FLUSH_INTERVAL = float(os.environ.get("MEMORY_FLUSH_INTERVAL", 60))
+# Facts that couldn't be written because the plugin was down wait here for the next flush
+MEMORY_SPILL_PATH = os.environ.get("MEMORY_SPILL_PATH", "memory_spill.jsonl")
+# Longest fact sent to /upsert, a reply is cut down to its sentences naming the most characters and places
+MEMORY_FACT_MAX_CHARS = int(os.environ.get("MEMORY_FACT_MAX_CHARS", 600))
+# Token-set overlap above which two facts count as the same memory. Condensed facts are short and
+# share the story's names, so near misses are common: only drop what is almost word for word
+MEMORY_DEDUPE_SIMILARITY = float(os.environ.get("MEMORY_DEDUPE_SIMILARITY", 0.9))
+RECENT_FACTS_PER_INDEX = 100
+
+
+def fact_tokens(text):
+    return frozenset(re.findall(r"\w+", text.lower()))
+
+
+def similarity(a, b):
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    return len(a & b) / len(a | b)
+
+
+def condense_fact(text, max_chars=MEMORY_FACT_MAX_CHARS):
+    """
+    Shortens a reply to the sentences worth remembering, no LLM involved.
+
+    Sentences are ranked by the names they mention (capitalised words that don't start the
+    sentence, as in function_calling.extract_memory_query) and kept in their original order
+    until max_chars is reached.
+
+    :param text: str, a reply or an explicit fact
+    :param max_chars: int
+    :return: str, text itself if it is already short enough
+    """
+    text = re.sub(r"[*_#>`]+", "", re.sub(r"\s+", " ", text)).strip()
+    if len(text) <= max_chars:
+        return text
+    sentences = re.findall(r"[^.!?]+[.!?]*", text)
+    names = [len(re.findall(r"(?<=[\w,;:] )[A-Z][\w'-]*", sentence)) for sentence in sentences]
+    kept = set()
+    length = 0
+    # Most names first, earlier sentences first among equals
+    for i in sorted(range(len(sentences)), key=lambda i: (-names[i], i)):
+        if length + len(sentences[i]) <= max_chars:
+            kept.add(i)
+            length += len(sentences[i])
+    if not kept:
+        # A single sentence longer than max_chars, cut it at a word
+        return text[:max_chars].rsplit(" ", 1)[0]
+    return "".join(sentences[i] for i in sorted(kept)).strip()
+
+
+def write_spill(path, facts, mode="a"):
+    # facts: dict of index to list of (text, worldtime)
+    with open(path, mode, encoding="utf-8") as spill_file:
+        for index, index_facts in facts.items():
+            for text, worldtime in index_facts:
+                spill_file.write(json.dumps({"index": index, "text": text, "worldtime": worldtime}) + "\n")
+
+
+class MemoryWriteBuffer:
+    """
+    Write-behind buffer for kernel-memory upserts.
+
+    Facts are collected per index, near-duplicates are dropped, and each flush sends one /upsert
+    per index holding the whole batch. A batch that fails is appended to a JSONL spill file and
+    retried on the next flush, including after a restart.
+    """
+
+    def __init__(self, flush_size=MEMORY_FLUSH_SIZE, flush_interval=MEMORY_FLUSH_INTERVAL, spill_path=MEMORY_SPILL_PATH):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.pending = {}
+        self.recent = {}
+        self.flush_task = None
+        # Flushes started by add(), referenced until they finish so they aren't garbage collected
+        self.flushes = set()
+        self.flush_lock = asyncio.Lock()
+        self.counters = {"added": 0, "deduped": 0, "flushes": 0, "documents": 0, "spilled": 0}
+
+    def start(self):
+        # Must be called from inside the running loop
+        self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        await asyncio.gather(*self.flushes, return_exceptions=True)
+        await self.flush()
+        logging.info(f"Memory write buffer stats at shutdown: {self.stats()}")
+
+    def add(self, text, index=function_calling.MEMORY_SEARCH_INDEX, flush_now=False):
+        """
+        Queues a fact to be remembered.
+
+        :param text: str, the fact, condensed to MEMORY_FACT_MAX_CHARS
+        :param index: str, kernel-memory index
+        :param flush_now: bool, write the index's batch right away (explicit !remember)
+        :return: bool, False if a near-identical fact was already queued or recently written
+        """
+        text = condense_fact(text)
+        if not text:
+            return False
+        tokens = fact_tokens(text)
+        recent = self.recent.setdefault(index, deque(maxlen=RECENT_FACTS_PER_INDEX))
+        pending = self.pending.setdefault(index, [])
+        if any(similarity(tokens, seen) >= MEMORY_DEDUPE_SIMILARITY for seen in recent):
+            self.counters["deduped"] += 1
+            return False
+        recent.append(tokens)
+        pending.append((text, datetime.now().strftime('%B %d %Y, %H:%M:%S')))
+        self.counters["added"] += 1
+        if flush_now or len(pending) >= self.flush_size:
+            flush = asyncio.create_task(self.flush(index))
+            self.flushes.add(flush)
+            flush.add_done_callback(self.flushes.discard)
+        return True
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                # A bad spill file or a full disk mustn't stop the periodic flushes
+                logging.exception("Memory write buffer flush failed")
+
+    async def flush(self, index=None):
+        async with self.flush_lock:
+            if index is None:
+                # Retry whatever an earlier failed flush spilled
+                await self.retry_spill()
+            for flush_index in [index] if index else list(self.pending):
+                facts = self.pending.pop(flush_index, [])
+                if facts:
+                    await self._write(flush_index, facts)
+
+    async def _write(self, index, facts, spill=True):
+        self.counters["flushes"] += 1
+        body = {
+            "index": index,
+            "documentId": f"dm_{datetime.now().strftime('%Y%m%d%H%M%S%f')}",
+            "text": "\n".join(f"Details of what happened or discussed: {text} WorldTime: {worldtime}" for text, worldtime in facts),
+        }
+        try:
+            apiresponse = await function_calling.call_memory_api("upsert", body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            apiresponse = f"Request failed. {e}"
+        if isinstance(apiresponse, str):
+            if spill:
+                logging.warning(f"Memory upsert of {len(facts)} facts failed, spilling to disk: {apiresponse}")
+                await asyncio.to_thread(write_spill, self.spill_path, {index: facts})
+                self.counters["spilled"] += len(facts)
+            else:
+                logging.warning(f"Retrying {len(facts)} spilled facts failed, keeping them on disk: {apiresponse}")
+            return False
+        self.counters["documents"] += 1
+        return True
+
+    def read_spill(self):
+        if not os.path.exists(self.spill_path):
+            return {}
+        facts = {}
+        with open(self.spill_path, encoding="utf-8") as spill_file:
+            for line in spill_file:
+                if line.strip():
+                    fact = json.loads(line)
+                    facts.setdefault(fact["index"], []).append((fact["text"], fact["worldtime"]))
+        return facts
+
+    def rewrite_spill(self, facts):
+        # Swap the file in one step so a crash leaves either the old or the new list, never neither
+        if not facts:
+            if os.path.exists(self.spill_path):
+                os.remove(self.spill_path)
+            return
+        write_spill(self.spill_path + ".tmp", facts, mode="w")
+        os.replace(self.spill_path + ".tmp", self.spill_path)
+
+    async def retry_spill(self):
+        # Runs under flush_lock, so no failed flush appends to the file meanwhile
+        spilled = await asyncio.to_thread(self.read_spill)
+        if not spilled:
+            return
+        logging.info(f"Retrying {sum(len(facts) for facts in spilled.values())} spilled memory facts")
+        failed = {index: facts for index, facts in spilled.items() if not await self._write(index, facts, spill=False)}
+        # The file only shrinks once its facts are stored, a crash before this retries them again
+        await asyncio.to_thread(self.rewrite_spill, failed)
+
+    def stats(self):
+        return {"pending": sum(len(facts) for facts in self.pending.values()), **self.counters}
+
+
+memory_writer = MemoryWriteBuffer()
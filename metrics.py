@@ -0,0 +1,187 @@
+import bisect
+import contextvars
+import functools
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# Prometheus text endpoint on METRICS_HOST:METRICS_PORT/metrics, 0 to disable
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+# One JSON line per finished span, empty to disable
+METRICS_TRACE_PATH = os.environ.get("METRICS_TRACE_PATH", "")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PREFIX = "llmcord"
+
+# Id of the Discord message whose handling is running, copied into every task it starts
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in labels) + "}"
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms for the message pipeline.
+
+    span() times one stage of handling a message: it feeds the stage_seconds histogram, keeps an
+    in-flight gauge per stage and, with METRICS_TRACE_PATH, writes a JSONL record tagged with the
+    message being handled. Components that already keep stats() register them as collectors and
+    are exported as gauges on every scrape.
+    """
+
+    def __init__(self, trace_path=METRICS_TRACE_PATH):
+        self.counters = defaultdict(float)
+        self.gauges = defaultdict(float)
+        self.histograms = defaultdict(Histogram)
+        self.collectors = {}
+        self.trace_file = open(trace_path, "a", encoding="utf-8") if trace_path else None
+        self.runner = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def set_gauge(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        self.histograms[self._key(name, labels)].observe(value)
+
+    def register(self, name, stats):
+        """
+        :param name: str, metric name prefix
+        :param stats: callable returning a dict of numbers, a dict of dicts is exported with a "key" label
+        """
+        self.collectors[name] = stats
+
+    def begin_trace(self, trace_id):
+        # Each Discord event runs in its own task, so this only tags the current message's spans
+        current_trace.set(trace_id)
+
+    @contextmanager
+    def span(self, stage, **labels):
+        in_flight = self._key("stage_in_flight", dict(labels, stage=stage))
+        self.gauges[in_flight] += 1
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            self.gauges[in_flight] -= 1
+            self.observe("stage_seconds", duration, stage=stage, **labels)
+            if error:
+                self.inc("stage_errors_total", stage=stage, error=error, **labels)
+            if self.trace_file:
+                self.trace_file.write(json.dumps({
+                    "trace": current_trace.get(),
+                    "span": stage,
+                    "labels": labels,
+                    "start": time.time() - duration,
+                    "duration": duration,
+                    "error": error,
+                }) + "\n")
+
+    def timed(self, stage):
+        """Decorator running every call of an async function inside span(stage)."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    async def measure(self, stage, awaitable):
+        with self.span(stage):
+            return await awaitable
+
+    def _collect(self):
+        lines = []
+        for name, stats in self.collectors.items():
+            try:
+                self._flatten(lines, PREFIX, {name: stats()}, ())
+            except Exception:
+                logging.exception(f"Metrics collector {name} failed")
+        return lines
+
+    def _flatten(self, lines, name, stats, labels):
+        for key, value in stats.items():
+            if isinstance(value, dict) and value and all(isinstance(nested, dict) for nested in value.values()):
+                # Stats per backend or provider, the inner keys become a label
+                for label, nested in value.items():
+                    self._flatten(lines, f"{name}_{key}", nested, labels + (("key", label),))
+            elif isinstance(value, dict):
+                self._flatten(lines, f"{name}_{key}", value, labels)
+            elif isinstance(value, (int, float)):
+                lines.append(f"{name}_{key}{label_text(labels)} {float(value)}")
+
+    def render(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{PREFIX}_{name}{label_text(labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            lines.append(f"{PREFIX}_{name}{label_text(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f"{PREFIX}_{name}_bucket{label_text(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{PREFIX}_{name}_bucket{label_text(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{PREFIX}_{name}_sum{label_text(labels)} {histogram.sum}")
+            lines.append(f"{PREFIX}_{name}_count{label_text(labels)} {histogram.count}")
+        lines += self._collect()
+        return "\n".join(lines) + "\n"
+
+    async def _handle_metrics(self, request):
+        return web.Response(text=self.render(), content_type="text/plain")
+
+    async def start(self, port=METRICS_PORT, host=METRICS_HOST):
+        if not port:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+        if self.trace_file:
+            self.trace_file.close()
+
+
+metrics = Metrics()
@@ -0,0 +1,263 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+MSG_CACHE_MAX_ENTRIES = int(os.environ.get("MSG_CACHE_MAX_ENTRIES", 5000))
+MSG_CACHE_MAX_BYTES = int(os.environ.get("MSG_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+# Evict down to this fraction of the limits so eviction runs in batches, not on every insert
+MSG_CACHE_LOW_WATERMARK = 0.9
+NODE_OVERHEAD_BYTES = 200
+
+# Optional on-disk copy of the cache so warm restarts rebuild reply chains without Discord fetches
+MSG_STORE_PATH = os.environ.get("MSG_STORE_PATH", "")
+MSG_STORE_FLUSH_INTERVAL = float(os.environ.get("MSG_STORE_FLUSH_INTERVAL", 2))
+MSG_STORE_MAX_CHAIN = 100
+
+
+class MsgNode:
+    __slots__ = ("msg_id", "role", "content", "name", "too_many_images", "replied_to", "size", "token_count")
+
+    def __init__(self, msg, too_many_images=False, replied_to=None):
+        self.msg_id = None
+        self.role = msg["role"]
+        self.content = msg["content"]
+        self.name = msg["name"]
+        self.too_many_images = too_many_images
+        self.replied_to = replied_to
+        self.size = NODE_OVERHEAD_BYTES + content_size(self.content)
+        # Filled in by the context builder the first time the node is sent
+        self.token_count = None
+
+    @property
+    def msg(self):
+        return {"role": self.role, "content": self.content, "name": self.name}
+
+
+def content_size(content):
+    if isinstance(content, str):
+        return len(content.encode("utf-8"))
+    # Vision content: a list of text and image_url parts
+    return sum(len(part.get("text", "").encode("utf-8")) + len(part.get("image_url", {}).get("url", "")) for part in content)
+
+
+class MsgNodeCache:
+    """
+    Bounded LRU mapping of Discord message id to MsgNode.
+
+    Eviction drops the least recently used nodes, oldest first. An evicted node stays reachable
+    from the replies that point at it, so cached nodes keep their chains, but its own chain is cut
+    max_chain hops up: older ancestors are freed instead of piling up behind the cache. The
+    on-disk store keeps every link.
+    """
+
+    def __init__(self, max_entries=MSG_CACHE_MAX_ENTRIES, max_bytes=MSG_CACHE_MAX_BYTES, store=None, max_chain=MSG_STORE_MAX_CHAIN):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.store = store
+        self.max_chain = max_chain
+        self.nodes = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, msg_id):
+        return self.get(msg_id) is not None
+
+    def __getitem__(self, msg_id):
+        node = self.nodes[msg_id]
+        self.nodes.move_to_end(msg_id)
+        return node
+
+    def get(self, msg_id, default=None):
+        node = self.nodes.get(msg_id)
+        if node is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.nodes.move_to_end(msg_id)
+        return node
+
+    def __setitem__(self, msg_id, node):
+        self._insert(msg_id, node)
+        if self.store:
+            self.store.save(node)
+
+    def _insert(self, msg_id, node):
+        node.msg_id = msg_id
+        old_node = self.nodes.pop(msg_id, None)
+        if old_node is not None:
+            self.bytes -= old_node.size
+        self.nodes[msg_id] = node
+        self.bytes += node.size
+        if len(self.nodes) > self.max_entries or self.bytes > self.max_bytes:
+            self.evict()
+
+    def _cut_chain(self, node):
+        # The replies to an evicted node are newer and still cached. Their walks of max_chain nodes
+        # end within max_chain hops of it, and can still tell the chain went on.
+        for _ in range(self.max_chain):
+            node = node.replied_to
+            if node is None:
+                return
+        node.replied_to = None
+
+    def link(self, msg_id, parent_id):
+        """
+        :param msg_id: int, id of a cached node
+        :param parent_id: int, id of the node it replies to
+        :return: bool, False if either node is no longer cached
+        """
+        node = self.nodes.get(msg_id)
+        parent = self.nodes.get(parent_id)
+        if node is None or parent is None:
+            # Evicted while the chain was being built, the next walk reloads it
+            return False
+        node.replied_to = parent
+        if self.store:
+            self.store.save(node)
+        return True
+
+    async def lookup(self, msg_id):
+        """
+        Like get(), but on a miss loads the node and its reply chain from the on-disk store.
+
+        :param msg_id: int, Discord message id
+        :return: MsgNode or None
+        """
+        node = self.get(msg_id)
+        if node is not None or not self.store:
+            return node
+        rows = await self.store.load_chain(msg_id)
+        if not rows:
+            return None
+        self.store_hits += 1
+        # Rows come leaf first, rebuild from the oldest so each node can point at its parent
+        parent = None
+        for row_id, role, content, name, too_many_images, replied_to in reversed(rows):
+            cached = self.nodes.get(row_id)
+            if cached is not None:
+                parent = cached
+                continue
+            node = MsgNode({"role": role, "content": json.loads(content), "name": name}, too_many_images=bool(too_many_images))
+            if parent is not None and parent.msg_id == replied_to:
+                node.replied_to = parent
+            self._insert(row_id, node)
+            parent = node
+        return self.nodes.get(msg_id)
+
+    def evict(self):
+        target_entries = int(self.max_entries * MSG_CACHE_LOW_WATERMARK)
+        target_bytes = int(self.max_bytes * MSG_CACHE_LOW_WATERMARK)
+        # Never evict the newest node, it is usually mid chain walk
+        while len(self.nodes) > 1 and (len(self.nodes) > target_entries or self.bytes > target_bytes):
+            _, node = self.nodes.popitem(last=False)
+            self.bytes -= node.size
+            self._cut_chain(node)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.nodes),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "store_hits": self.store_hits,
+            "evictions": self.evictions,
+        }
+
+
+class MsgNodeStore:
+    """
+    SQLite table of message nodes and their reply links.
+
+    Saves are buffered and written by a background task. Reads happen only on a cache miss.
+    """
+
+    def __init__(self, path, flush_interval=MSG_STORE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.flush_task = None
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS msg_nodes ("
+            "id INTEGER PRIMARY KEY, role TEXT, content TEXT, name TEXT, too_many_images INTEGER, replied_to INTEGER)"
+        )
+        self.conn.commit()
+
+    def start(self):
+        # Must be called from inside the running loop
+        self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        await self.flush()
+        self.conn.close()
+
+    def save(self, node):
+        self.dirty[node.msg_id] = node
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except sqlite3.Error:
+                logging.exception("Failed to write message nodes to the store")
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        rows = [
+            (
+                msg_id,
+                node.role,
+                json.dumps(node.content),
+                node.name,
+                int(node.too_many_images),
+                node.replied_to.msg_id if node.replied_to is not None else None,
+            )
+            for msg_id, node in dirty.items()
+        ]
+        try:
+            await asyncio.to_thread(self._write, rows)
+        except sqlite3.Error:
+            # Keep the nodes for the next attempt unless they were saved again meanwhile
+            self.dirty = {**dirty, **self.dirty}
+            raise
+
+    def _write(self, rows):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO msg_nodes VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    async def load_chain(self, msg_id, max_depth=MSG_STORE_MAX_CHAIN):
+        return await asyncio.to_thread(self._read_chain, msg_id, max_depth)
+
+    def _read_chain(self, msg_id, max_depth):
+        with self.lock:
+            return self.conn.execute(
+                "WITH RECURSIVE chain(id, role, content, name, too_many_images, replied_to, depth) AS ("
+                " SELECT id, role, content, name, too_many_images, replied_to, 0 FROM msg_nodes WHERE id = ?"
+                " UNION ALL"
+                " SELECT m.id, m.role, m.content, m.name, m.too_many_images, m.replied_to, chain.depth + 1"
+                " FROM msg_nodes m JOIN chain ON m.id = chain.replied_to WHERE chain.depth < ?"
+                ") SELECT id, role, content, name, too_many_images, replied_to FROM chain ORDER BY depth",
+                (msg_id, max_depth),
+            ).fetchall()
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from llmcord_utils import synthesizeAudio, sendAudio, synthesizeAndSendAudio
+from stream_text import ThinkFilter, TextSplitter, SENTENCE_END
+
+# Narrate replies sentence by sentence while they stream instead of once at the end
+STREAMING_TTS = bool(int(os.environ.get("STREAMING_TTS", 0)))
+TTS_SEND_URL = os.environ.get("TTS_SEND_URL", "http://localhost:5000/synthesize_and_send")
+# Endpoint returning audio bytes for {"text": ...}. With it, sentences are synthesized ahead of
+# delivery; without it each sentence goes through TTS_SEND_URL one at a time.
+TTS_SYNTHESIZE_URL = os.environ.get("TTS_SYNTHESIZE_URL", "")
+# Synthesis requests in flight across all replies, the TTS server shares our GPU
+TTS_PIPELINE_DEPTH = int(os.environ.get("TTS_PIPELINE_DEPTH", 2))
+TTS_MIN_SENTENCE_CHARS = int(os.environ.get("TTS_MIN_SENTENCE_CHARS", 40))
+
+
+class NarrationStream:
+    """One reply's narration: feed it streamed chunks, close it when the stream ends."""
+
+    def __init__(self, narrator, webhook_url):
+        self.narrator = narrator
+        self.webhook_url = webhook_url
+        self.think_filter = ThinkFilter()
+        self.splitter = TextSplitter(SENTENCE_END, TTS_MIN_SENTENCE_CHARS)
+        self.segments = asyncio.Queue()
+        self.opened_at = time.monotonic()
+        self.delivered = 0
+        self.delivery = asyncio.create_task(self._deliver())
+
+    def feed(self, chunk):
+        for sentence in self.splitter.feed(self.think_filter.feed(chunk)):
+            self._queue(sentence)
+
+    def close(self):
+        for sentence in self.splitter.feed(self.think_filter.finish()) + self.splitter.finish():
+            self._queue(sentence)
+        self.segments.put_nowait(None)
+
+    def abort(self):
+        # The reply broke off, drop what hasn't been spoken yet
+        self.delivery.cancel()
+
+    def _queue(self, sentence):
+        self.narrator.counters["sentences"] += 1
+        if TTS_SYNTHESIZE_URL:
+            # Synthesis starts now, _deliver posts the results in order
+            self.segments.put_nowait(asyncio.create_task(self.narrator.synthesize(sentence)))
+        else:
+            self.segments.put_nowait(sentence)
+
+    async def _deliver(self):
+        index = 0
+        segment = None
+        try:
+            while (segment := await self.segments.get()) is not None:
+                index += 1
+                try:
+                    if isinstance(segment, str):
+                        async with self.narrator.semaphore:
+                            message = await synthesizeAndSendAudio(api_url=TTS_SEND_URL, text=segment, webhook_url=self.webhook_url)
+                        # The helper reports failures as a status string instead of raising
+                        if isinstance(message, str) and message.startswith("Failed to synthesize"):
+                            raise RuntimeError(message)
+                    else:
+                        audio = await segment
+                        if audio is None:
+                            self.narrator.counters["failed"] += 1
+                            continue
+                        await sendAudio(self.webhook_url, audio, filename=f"speech_{index}.wav")
+                except Exception as e:
+                    self.narrator.counters["failed"] += 1
+                    logging.warning(f"Could not narrate sentence {index}: {e!r}")
+                    continue
+                if self.delivered == 0:
+                    self.narrator.first_audio.append(time.monotonic() - self.opened_at)
+                self.delivered += 1
+                self.narrator.counters["delivered"] += 1
+        finally:
+            # Cancelled or aborted: synthesis already started for later sentences is not needed
+            pending = [segment] if isinstance(segment, asyncio.Task) else []
+            while not self.segments.empty():
+                pending.append(self.segments.get_nowait())
+            pending = [task for task in pending if isinstance(task, asyncio.Task)]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+class Narrator:
+    """
+    Sentence-level TTS for streamed replies.
+
+    Sentences are cut out of the stream as soon as they end, skipping <think> blocks, and handed
+    to the TTS server while the LLM keeps generating. Audio is posted in sentence order, so the
+    first line is heard after one sentence instead of after the whole reply.
+    """
+
+    def __init__(self, pipeline_depth=TTS_PIPELINE_DEPTH):
+        self.semaphore = asyncio.Semaphore(pipeline_depth)
+        self.streams = set()
+        self.counters = {"replies": 0, "sentences": 0, "delivered": 0, "failed": 0}
+        self.first_audio = deque(maxlen=200)
+
+    def open(self, webhook_url):
+        self.counters["replies"] += 1
+        stream = NarrationStream(self, webhook_url)
+        self.streams.add(stream)
+        stream.delivery.add_done_callback(lambda _: self.streams.discard(stream))
+        return stream
+
+    async def synthesize(self, text):
+        async with self.semaphore:
+            try:
+                return await synthesizeAudio(TTS_SYNTHESIZE_URL, text)
+            except Exception as e:
+                logging.warning(f"Could not synthesize sentence: {e!r}")
+                return None
+
+    async def stop(self):
+        logging.info(f"Narrator stats at shutdown: {self.stats()}")
+        deliveries = [stream.delivery for stream in self.streams]
+        for delivery in deliveries:
+            delivery.cancel()
+        await asyncio.gather(*deliveries, return_exceptions=True)
+
+    def stats(self):
+        first_audio = sorted(self.first_audio)
+        return {
+            "streaming": len(self.streams),
+            "first_audio_p50": first_audio[len(first_audio) // 2] if first_audio else 0.0,
+            **self.counters,
+        }
+
+
+narrator = Narrator()
@@ -0,0 +1,69 @@
+import os
+import re
+
+from function_calling import STOPWORDS
+from stream_text import ThinkFilter, TextSplitter, PARAGRAPH_END
+
+# Start the scene image from the first finished paragraph instead of the whole reply
+SPECULATIVE_SCENE_IMAGE = bool(int(os.environ.get("SPECULATIVE_SCENE_IMAGE", 0)))
+# A paragraph whose keywords are at least this new to the current scene starts a new scene
+SCENE_CHANGE_THRESHOLD = float(os.environ.get("SCENE_CHANGE_THRESHOLD", 0.8))
+# Paragraphs with fewer keywords are too thin to picture and are merged into the next one
+SCENE_MIN_KEYWORDS = int(os.environ.get("SCENE_MIN_KEYWORDS", 6))
+SCENE_MAX_REPLACEMENTS = int(os.environ.get("SCENE_MAX_REPLACEMENTS", 2))
+
+
+def scene_keywords(text):
+    return {word for word in re.findall(r"\w+", text.lower()) if len(word) >= 4 and word not in STOPWORDS}
+
+
+class SceneTracker:
+    """
+    Picks the paragraph a reply's scene image should show while the reply is still streaming.
+
+    The first visible paragraph with enough keywords becomes the scene. Later paragraphs mostly
+    made of new keywords replace it, up to SCENE_MAX_REPLACEMENTS times; the rest only widen the
+    scene's vocabulary, so describing the same place at length doesn't restart the image.
+    """
+
+    def __init__(self):
+        self.think_filter = ThinkFilter()
+        self.splitter = TextSplitter(PARAGRAPH_END)
+        self.pending = ""
+        self.scene = None
+        self.scene_words = set()
+        self.replacements = 0
+
+    def feed(self, chunk):
+        """
+        :param chunk: str, newly streamed text
+        :return: str or None, the paragraph to (re)generate the scene image from
+        """
+        scene = None
+        for paragraph in self.splitter.feed(self.think_filter.feed(chunk)):
+            scene = self._consider(paragraph) or scene
+        return scene
+
+    def close(self):
+        scene = None
+        for paragraph in self.splitter.feed(self.think_filter.finish()) + self.splitter.finish():
+            scene = self._consider(paragraph) or scene
+        return scene
+
+    def _consider(self, paragraph):
+        paragraph = f"{self.pending}\n\n{paragraph}" if self.pending else paragraph
+        words = scene_keywords(paragraph)
+        if len(words) < SCENE_MIN_KEYWORDS:
+            self.pending = paragraph
+            return None
+        self.pending = ""
+
+        if self.scene is not None:
+            novelty = len(words - self.scene_words) / len(words)
+            if novelty < SCENE_CHANGE_THRESHOLD or self.replacements >= SCENE_MAX_REPLACEMENTS:
+                self.scene_words |= words
+                return None
+            self.replacements += 1
+        self.scene = paragraph
+        self.scene_words = words
+        return paragraph
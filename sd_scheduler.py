@@ -0,0 +1,232 @@
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import time
+from collections import deque
+
+import aiohttp
+
+from job_queue import PRIORITY_NORMAL
+from llmcord_utils import txt2img, interruptImage, sendImages
+
+# The WebUI renders one job at a time; requests with the same render settings are taken together,
+# SD_MAX_BATCH_IMAGES at most, and those with the same prompt too share a call of up to
+# SD_MAX_BATCH_SIZE images per iteration
+SD_MAX_BATCH_SIZE = int(os.environ.get("SD_MAX_BATCH_SIZE", 4))
+SD_MAX_BATCH_IMAGES = int(os.environ.get("SD_MAX_BATCH_IMAGES", 8))
+SD_MAX_PENDING = int(os.environ.get("SD_MAX_PENDING", 8))
+# Seconds allowed per image of a batch before the txt2img call is abandoned
+SD_TXT2IMG_TIMEOUT = float(os.environ.get("SD_TXT2IMG_TIMEOUT", 120))
+# Interrupt the WebUI when every request of the running batch has been superseded
+SD_INTERRUPT_SUPERSEDED = bool(int(os.environ.get("SD_INTERRUPT_SUPERSEDED", 1)))
+# Payload fields that have to match for requests to be rendered back to back: the checkpoint
+# (override_settings), size, steps, sampler and cfg
+RENDER_SETTINGS = ("override_settings", "width", "height", "steps", "sampler_name", "sampler_index", "cfg_scale", "alwayson_scripts")
+
+
+class ImageRequest:
+    __slots__ = ("webhook_url", "payload", "priority", "coalesce_key", "seq", "enqueued_at", "superseded")
+
+    def __init__(self, webhook_url, payload, priority, coalesce_key, seq):
+        self.webhook_url = webhook_url
+        self.payload = payload
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.superseded = False
+
+
+def batch_key(payload):
+    return json.dumps({name: payload.get(name) for name in RENDER_SETTINGS}, sort_keys=True)
+
+
+def prompt_key(payload):
+    # Only requests whose whole payload matches can share a txt2img call, the API takes one prompt
+    return json.dumps(payload, sort_keys=True)
+
+
+class SDScheduler:
+    """
+    Single worker in front of the Stable Diffusion WebUI.
+
+    A newer request with the same coalesce key (the channel) replaces one that is still queued, and
+    one that is already rendering is skipped when its images come back. While a call is running,
+    requests accumulate; the next batch takes those with the head's render settings, so the
+    WebUI doesn't switch checkpoints or sizes in between. Within it, requests with the same prompt
+    are rendered together with batch_size/n_iter and differing prompts get a call each, every
+    image going back to the webhook that asked for it.
+    """
+
+    def __init__(self, max_batch_size=SD_MAX_BATCH_SIZE, max_batch_images=SD_MAX_BATCH_IMAGES, max_pending=SD_MAX_PENDING):
+        self.max_batch_size = max_batch_size
+        self.max_batch_images = max_batch_images
+        self.max_pending = max_pending
+        self.pending = []
+        self.queued = {}
+        self.running = []
+        self.wakeup = None
+        self.worker = None
+        self.counter = itertools.count()
+        self.counters = {"submitted": 0, "coalesced": 0, "dropped": 0, "calls": 0, "batched": 0, "images": 0, "superseded": 0, "interrupts": 0, "failed": 0}
+        self.wait_times = deque(maxlen=200)
+
+    def start(self):
+        # Must be called from inside the running loop
+        self.wakeup = asyncio.Event()
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        logging.info(f"SD scheduler stats at shutdown: {self.stats()}")
+        if self.worker:
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+
+    def submit(self, webhook_url, payload, priority=PRIORITY_NORMAL, coalesce_key=None):
+        """
+        Queues a txt2img request.
+
+        :param webhook_url: str, webhook the images are posted to
+        :param payload: dict, txt2img parameters (prompt, steps, cfg_scale, sampler_index, seed, ...)
+        :param priority: int, lower runs first
+        :param coalesce_key: optional hashable, a newer request with the same key supersedes older ones
+        :return: bool, False if the request was dropped
+        """
+        self.counters["submitted"] += 1
+        # Check capacity before superseding, a dropped request must not take the older scene with it
+        replaces_queued = coalesce_key is not None and self.queued.get(coalesce_key) in self.pending
+        if len(self.pending) - replaces_queued >= self.max_pending:
+            self.counters["dropped"] += 1
+            logging.warning(f"Dropped image request, {len(self.pending)} already queued")
+            return False
+        if coalesce_key is not None:
+            self._supersede(coalesce_key)
+
+        request = ImageRequest(webhook_url, payload, priority, coalesce_key, next(self.counter))
+        self.pending.append(request)
+        if coalesce_key is not None:
+            self.queued[coalesce_key] = request
+        self.wakeup.set()
+        return True
+
+    def _supersede(self, coalesce_key):
+        queued_request = self.queued.pop(coalesce_key, None)
+        if queued_request is not None and queued_request in self.pending:
+            # Only the newest scene matters, the old one never reaches the GPU
+            self.pending.remove(queued_request)
+            self.counters["coalesced"] += 1
+        running = [request for request in self.running if request.coalesce_key == coalesce_key]
+        for request in running:
+            request.superseded = True
+        if running and SD_INTERRUPT_SUPERSEDED and all(request.superseded for request in self.running):
+            self.counters["interrupts"] += 1
+            asyncio.create_task(self._interrupt())
+
+    async def _interrupt(self):
+        try:
+            await interruptImage()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Could not interrupt the WebUI: {e}")
+
+    def _next_batch(self):
+        head = min(self.pending, key=lambda request: (request.priority, request.seq))
+        key = batch_key(head.payload)
+        batch = [head] + [request for request in self.pending if request is not head and batch_key(request.payload) == key]
+        batch = batch[:self.max_batch_images]
+        for request in batch:
+            self.pending.remove(request)
+            if self.queued.get(request.coalesce_key) is request:
+                del self.queued[request.coalesce_key]
+        return batch
+
+    async def _run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending:
+                self.running = self._next_batch()
+                try:
+                    await self._render(self.running)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.counters["failed"] += 1
+                    logging.exception("Image generation failed")
+                finally:
+                    self.running = []
+
+    async def _render(self, batch):
+        now = time.monotonic()
+        self.wait_times.extend(now - request.enqueued_at for request in batch)
+        groups = {}
+        for request in batch:
+            groups.setdefault(prompt_key(request.payload), []).append(request)
+        for group in groups.values():
+            if all(request.superseded for request in group):
+                # Replaced by a newer scene while earlier prompts of the batch were rendering
+                self.counters["superseded"] += len(group)
+                continue
+            try:
+                await self._render_group(group)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The other prompts of the batch still get their call
+                self.counters["failed"] += 1
+                logging.exception("Image generation failed")
+
+    async def _render_group(self, batch):
+        payload = dict(batch[0].payload)
+        # A fixed seed renders the same image for every request, so one image is fanned out to all
+        images_needed = len(batch) if payload.get("seed", -1) == -1 else 1
+        batch_size = min(images_needed, self.max_batch_size)
+        n_iter = math.ceil(images_needed / batch_size)
+        if images_needed > 1:
+            # Keep the grid image out of the results so they map one to one onto the requests
+            payload.update(batch_size=batch_size, n_iter=n_iter, do_not_save_grid=True)
+
+        self.counters["calls"] += 1
+        if len(batch) > 1:
+            self.counters["batched"] += len(batch)
+        status, images = await txt2img(payload, timeout=aiohttp.ClientTimeout(total=SD_TXT2IMG_TIMEOUT * batch_size * n_iter))
+        if status != 200 or not images:
+            self.counters["failed"] += 1
+            logging.warning(f"txt2img returned status {status} with {len(images)} images")
+            return
+        self.counters["images"] += len(images)
+
+        for i, request in enumerate(batch):
+            if request.superseded:
+                self.counters["superseded"] += 1
+                continue
+            if len(batch) == 1:
+                # Send everything back, including extra images from always-on scripts
+                request_images = images
+            elif images_needed == 1:
+                request_images = images[:1]
+            else:
+                request_images = images[i:i + 1]
+            if not request_images:
+                continue
+            try:
+                await sendImages(request.webhook_url, request_images)
+            except Exception as e:
+                # One bad webhook must not cost the rest of the batch their images
+                self.counters["failed"] += 1
+                logging.warning(f"Could not post generated image to webhook: {e!r}")
+
+    def stats(self):
+        wait_times = sorted(self.wait_times)
+        return {
+            "depth": len(self.pending),
+            "running": len(self.running),
+            "wait_p50": wait_times[len(wait_times) // 2] if wait_times else 0.0,
+            "wait_max": wait_times[-1] if wait_times else 0.0,
+            **self.counters,
+        }
+
+
+sd_scheduler = SDScheduler()
@@ -0,0 +1,77 @@
+import re
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+# Sentence punctuation (plus closing quotes/brackets/markdown) followed by whitespace, or a line break
+SENTENCE_END = re.compile(r"[.!?…]+[\"'”’)\]*_]*\s+|\n\s*")
+PARAGRAPH_END = re.compile(r"\n\s*\n")
+
+
+def partial_suffix(text, tag):
+    # Length of the longest tail of text that is a prefix of tag
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+
+class ThinkFilter:
+    """Drops <think>...</think> from streamed chunks, tags may be split across chunks."""
+
+    def __init__(self):
+        self.buffer = ""
+        self.thinking = False
+
+    def feed(self, chunk):
+        """
+        :param chunk: str, newly streamed text
+        :return: str, the visible text that is now certain to be outside a think block
+        """
+        self.buffer += chunk
+        visible = []
+        while True:
+            tag = THINK_CLOSE if self.thinking else THINK_OPEN
+            index = self.buffer.find(tag)
+            if index == -1:
+                # Hold back anything that could be the start of a split tag
+                keep = partial_suffix(self.buffer, tag)
+                if not self.thinking:
+                    visible.append(self.buffer[:len(self.buffer) - keep])
+                self.buffer = self.buffer[len(self.buffer) - keep:]
+                return "".join(visible)
+            if not self.thinking:
+                visible.append(self.buffer[:index])
+            self.buffer = self.buffer[index + len(tag):]
+            self.thinking = not self.thinking
+
+    def finish(self):
+        # An unclosed think block is dropped
+        text = "" if self.thinking else self.buffer
+        self.buffer = ""
+        return text
+
+
+class TextSplitter:
+    """Cuts visible text into sentences or paragraphs as soon as they end, merging ones shorter than min_chars."""
+
+    def __init__(self, boundary=SENTENCE_END, min_chars=0):
+        self.boundary = boundary
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text):
+        self.buffer += text
+        pieces = []
+        start = 0
+        for match in self.boundary.finditer(self.buffer):
+            piece = self.buffer[start:match.end()].strip()
+            if len(piece) >= self.min_chars:
+                pieces.append(piece)
+                start = match.end()
+        self.buffer = self.buffer[start:]
+        return pieces
+
+    def finish(self):
+        piece = self.buffer.strip()
+        self.buffer = ""
+        return [piece] if piece else []
@@ -0,0 +1,72 @@
+import os
+
+from context_builder import MEMORY_PLACEHOLDER, count_tokens
+
+IMAGE_PLACEHOLDER = "(%isee%)"
+# Ask the server for usage on the last stream chunk, to see how much of the prompt it served from cache
+REPORT_PROMPT_USAGE = bool(int(os.environ.get("REPORT_PROMPT_USAGE", 0)))
+
+
+def prompt_text(messages):
+    return "\n".join(f"{message['role']}:{message['content']}" for message in messages if isinstance(message["content"], str))
+
+
+class SystemPromptTemplate:
+    """
+    System prompt laid out for the servers' prefix (KV) caches.
+
+    Static instructions are compiled once per config and always come first; the volatile
+    section (date, memories, what the bot sees) is appended after them. Consecutive requests
+    therefore share the whole static prefix, which stats() tracks on our side and, with
+    REPORT_PROMPT_USAGE, as cached prompt tokens reported by the server.
+    """
+
+    def __init__(self, compile_static):
+        """
+        :param compile_static: callable taking the config tuple and returning the static instructions
+        """
+        self.compile_static = compile_static
+        self.config = None
+        self.static = None
+        self.static_tokens = 0
+        self.last_prompt = ""
+        self.counters = {"builds": 0, "compiles": 0, "shared_prefix_tokens": 0, "prompt_tokens": 0, "server_prompt_tokens": 0, "server_cached_tokens": 0}
+
+    def render(self, config, volatile):
+        """
+        :param config: hashable tuple of everything the static instructions depend on
+        :param volatile: str, per-request section, may hold MEMORY_PLACEHOLDER for the context builder
+        :return: list with the system message
+        """
+        if config != self.config:
+            static = self.compile_static(config)
+            # Volatile placeholders inside the configured prompt would split the prefix, their content moves to the end
+            self.static = static.replace(MEMORY_PLACEHOLDER, "").replace(IMAGE_PLACEHOLDER, "")
+            self.static_tokens = count_tokens(self.static)
+            self.config = config
+            self.counters["compiles"] += 1
+        self.counters["builds"] += 1
+        return [{"role": "system", "content": f"{self.static}\n\n{volatile}"}]
+
+    def record_prompt(self, messages):
+        # How much of this prompt repeats the previous one verbatim, what a prefix cache can reuse
+        prompt = prompt_text(messages)
+        shared = os.path.commonprefix([prompt, self.last_prompt])
+        self.last_prompt = prompt
+        self.counters["shared_prefix_tokens"] += count_tokens(shared)
+        self.counters["prompt_tokens"] += count_tokens(prompt)
+
+    def record_usage(self, usage):
+        self.counters["server_prompt_tokens"] += usage.prompt_tokens or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.counters["server_cached_tokens"] += getattr(details, "cached_tokens", None) or 0
+
+    def stats(self):
+        prompt_tokens = self.counters["prompt_tokens"]
+        server_prompt_tokens = self.counters["server_prompt_tokens"]
+        return {
+            "static_tokens": self.static_tokens,
+            "prefix_reuse": self.counters["shared_prefix_tokens"] / prompt_tokens if prompt_tokens else 0.0,
+            "server_cache_hit_rate": self.counters["server_cached_tokens"] / server_prompt_tokens if server_prompt_tokens else 0.0,
+            **self.counters,
+        }
@@ -0,0 +1,55 @@
+from msg_cache import MsgNode, MsgNodeCache
+
+MAX_MESSAGES = 20
+
+
+def make_node(i):
+    return MsgNode({"role": "user", "content": f"message {i}", "name": None})
+
+
+def build_chain(cache, length):
+    # Each message replies to the one before it, like a long Discord reply chain
+    for i in range(length):
+        cache[i] = make_node(i)
+        if i:
+            assert cache.link(i, i - 1)
+
+
+def walk(node):
+    chain = []
+    while node is not None:
+        chain.append(node.msg_id)
+        node = node.replied_to
+    return chain
+
+
+def test_chain_longer_than_cache_keeps_newest_links():
+    cache = MsgNodeCache(max_entries=1000, max_chain=MAX_MESSAGES)
+    build_chain(cache, 3000)
+
+    assert len(cache) <= 1000
+    # Oldest first: the tip and its recent ancestors survive eviction
+    assert 2999 in cache.nodes and 0 not in cache.nodes
+    # Every cached node, not only the tip, still walks back over MAX_MESSAGES nodes
+    for tip, node in cache.nodes.items():
+        chain = walk(node)
+        assert chain[:MAX_MESSAGES + 1] == list(range(tip, tip - MAX_MESSAGES - 1, -1))
+
+
+def test_evicted_ancestors_are_unreachable():
+    cache = MsgNodeCache(max_entries=100, max_chain=MAX_MESSAGES)
+    build_chain(cache, 500)
+
+    # Only nodes a cached node can still walk to are kept alive
+    reachable = {msg_id for node in cache.nodes.values() for msg_id in walk(node)}
+    assert len(reachable) <= len(cache) + MAX_MESSAGES + 1
+    assert 0 not in reachable
+
+
+def test_link_skips_evicted_nodes():
+    cache = MsgNodeCache(max_entries=10, max_chain=MAX_MESSAGES)
+    build_chain(cache, 50)
+
+    assert not cache.link(49, 0)
+    assert not cache.link(0, 49)
+    assert cache.nodes[49].replied_to.msg_id == 48
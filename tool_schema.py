@@ -0,0 +1,103 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+
+import aiohttp
+import jsonref
+
+import function_calling
+from http_sessions import get_session
+from worker_pool import worker_pool
+
+TOOL_SCHEMA_CACHE_PATH = os.environ.get("TOOL_SCHEMA_CACHE_PATH", "tool_schema_cache.json")
+TOOL_SCHEMA_REFRESH_INTERVAL = float(os.environ.get("TOOL_SCHEMA_REFRESH_INTERVAL", 600))
+SPEC_FETCH_TIMEOUT = aiohttp.ClientTimeout(total=15)
+
+
+def compile_spec(spec_text):
+    # Resolve $refs and flatten to plain dicts so the result can be cached as JSON
+    openapi_spec = jsonref.loads(spec_text)
+    return json.loads(jsonref.dumps(function_calling.openapi_to_functions(openapi_spec)))
+
+
+class ToolSchema:
+    """
+    OpenAPI tool definitions for the memory plugin, compiled once and cached on disk.
+
+    `functions` is a list that is updated in place, so callers holding it see refreshes without
+    re-reading the attribute.
+    """
+
+    def __init__(self, spec_url, cache_path=TOOL_SCHEMA_CACHE_PATH):
+        self.spec_url = spec_url
+        self.cache_path = cache_path
+        self.functions = []
+        self.spec_hash = None
+        self.etag = None
+        self.refresh_task = None
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path, encoding="utf-8") as cache_file:
+                cache = json.load(cache_file)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            logging.exception("Ignoring unreadable tool schema cache")
+            return False
+        self.functions[:] = cache["functions"]
+        self.spec_hash = cache.get("hash")
+        self.etag = cache.get("etag")
+        return True
+
+    def save_cache(self):
+        with open(self.cache_path, "w", encoding="utf-8") as cache_file:
+            json.dump({"hash": self.spec_hash, "etag": self.etag, "functions": self.functions}, cache_file)
+
+    async def refresh(self):
+        """
+        Fetches swagger.json and swaps in new functions if the spec changed.
+
+        :return: bool, True if the functions were replaced
+        """
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        async with get_session("memory").get(self.spec_url, headers=headers, timeout=SPEC_FETCH_TIMEOUT) as response:
+            if response.status == 304:
+                return False
+            response.raise_for_status()
+            spec_text = await response.text()
+            etag = response.headers.get("ETag")
+
+        spec_hash = hashlib.sha256(spec_text.encode("utf-8")).hexdigest()
+        if spec_hash == self.spec_hash:
+            self.etag = etag
+            return False
+        functions = await worker_pool.run(compile_spec, spec_text)
+        self.functions[:] = functions
+        self.spec_hash = spec_hash
+        self.etag = etag
+        await asyncio.to_thread(self.save_cache)
+        logging.info(f"Loaded {len(functions)} tool definitions from {self.spec_url}")
+        return True
+
+    def start(self):
+        # Must be called from inside the running loop
+        self.refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self.refresh_task:
+            self.refresh_task.cancel()
+            await asyncio.gather(self.refresh_task, return_exceptions=True)
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logging.warning(f"Could not refresh tool schema from {self.spec_url}: {e}")
+            except Exception:
+                # Anything else (a spec compile_spec can't handle, a full disk) mustn't end the refreshes
+                logging.exception(f"Tool schema refresh from {self.spec_url} failed")
+            await asyncio.sleep(TOOL_SCHEMA_REFRESH_INTERVAL)
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Processes for CPU-bound work (image decoding and resizing, tool schema compilation), 0 runs it
+# on a thread of this process instead
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 0))
+
+
+class WorkerPool:
+    """
+    Runs CPU-bound functions off the event loop.
+
+    With WORKER_PROCESSES, calls go through a ProcessPoolExecutor, whose multiprocessing queues
+    carry the arguments and results, so the work doesn't hold this process's GIL. Functions and
+    arguments must then be picklable: plain module-level functions of bytes, str and dicts.
+    Without processes, or when the pool has died, calls fall back to asyncio.to_thread.
+    """
+
+    def __init__(self, processes=WORKER_PROCESSES):
+        self.processes = processes
+        self.executor = None
+        self.counters = {"process_calls": 0, "thread_calls": 0, "failed": 0, "broken": 0}
+
+    def start(self):
+        if self.processes > 0:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes)
+            # Workers are created on the first submit, get them forked before we start any threads
+            self.executor.submit(int)
+            logging.info(f"Started {self.processes} worker processes")
+
+    async def close(self):
+        if self.executor:
+            executor, self.executor = self.executor, None
+            await asyncio.to_thread(executor.shutdown, cancel_futures=True)
+
+    async def run(self, func, *args):
+        """
+        :param func: module-level function
+        :param args: picklable arguments
+        :return: func(*args)
+        """
+        if self.executor:
+            try:
+                self.counters["process_calls"] += 1
+                return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+            except BrokenProcessPool:
+                # A worker was killed (OOM, segfault in a decoder), keep serving from threads
+                self.counters["broken"] += 1
+                logging.exception("Worker pool broke, running CPU-bound work on threads")
+                self.executor = None
+            except Exception:
+                self.counters["failed"] += 1
+                raise
+        self.counters["thread_calls"] += 1
+        return await asyncio.to_thread(func, *args)
+
+    def stats(self):
+        return {"processes": self.processes if self.executor else 0, **self.counters}
+
+
+worker_pool = WorkerPool()